@@ -0,0 +1,166 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import ANALYSIS_CACHE_PATH, VISION_MODEL, VISION_PROMPT, SCREENSHOT_VISION_PROMPT
+
+
+def file_sha1(path: str) -> str:
+    """计算文件内容的SHA-1（Python 3.11+ 的 hashlib.file_digest 直接在C层分块读取）"""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+        digest = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def prompt_version(screenshot_mode: bool) -> str:
+    """模型名称和提示词的摘要；修改模型或提示词后旧的分析结果不再命中"""
+    prompt = SCREENSHOT_VISION_PROMPT if screenshot_mode else VISION_PROMPT
+    return hashlib.sha1(f'{VISION_MODEL}\0{prompt}'.encode('utf-8')).hexdigest()[:16]
+
+
+class AnalysisCache:
+    """按图片内容哈希缓存Vision API的分析结果
+
+    重新运行时，内容未变的图片（例如metadata被其他工具清掉）直接复用上次的描述，
+    不再重复调用API。缓存键包含模型名称和提示词摘要：普通模式和截图模式分开缓存，
+    修改模型或提示词后旧结果自动失效。
+    """
+
+    # 攒够这么多条再提交一次事务，减少fsync次数
+    COMMIT_EVERY = 100
+
+    def __init__(self, path: str = ANALYSIS_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 分析在线程池中进行，连接跨线程共享，由锁保证串行访问
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # 旧版本的缓存键不含模型和提示词，无法判断是否过期，直接丢弃
+        self._conn.execute('DROP TABLE IF EXISTS cache')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS analysis ('
+            'sha TEXT NOT NULL, version TEXT NOT NULL, description TEXT NOT NULL, ts INTEGER NOT NULL, '
+            'PRIMARY KEY (sha, version))'
+        )
+        self._versions = {mode: prompt_version(mode) for mode in (False, True)}
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def get(self, sha: str, screenshot_mode: bool) -> Optional[str]:
+        """查询缓存，未命中返回None"""
+        with self._lock:
+            # 尚未提交的结果也要能查到（同一批中可能有内容相同的图片）
+            key = (sha, self._versions[bool(screenshot_mode)])
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending[0]
+            row = self._conn.execute(
+                'SELECT description FROM analysis WHERE sha = ? AND version = ?', key
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, sha: str, screenshot_mode: bool, description: str):
+        """写入缓存（批量提交）"""
+        with self._lock:
+            self._pending[(sha, self._versions[bool(screenshot_mode)])] = (description, int(time.time()))
+            if len(self._pending) >= self.COMMIT_EVERY:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?)',
+                [(sha, version, description, ts) for (sha, version), (description, ts) in self._pending.items()]
+            )
+        self._pending = {}
+
+    def close(self):
+        """提交尚未写入的结果并关闭数据库"""
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+class MetadataIndex:
+    """记录每个文件是否已有metadata，以 (mtime_ns, size) 判断文件是否变化
+
+    重新运行时，自上次检查后没有变化的文件不必再启动exiftool探测。
+    与 AnalysisCache 使用同一个数据库文件。
+    """
+
+    COMMIT_EVERY = 100
+    # 单条查询绑定的路径数（旧版SQLite最多999个变量）
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path: str = ANALYSIS_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS metadata_index ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, has_meta INTEGER NOT NULL)'
+        )
+        self._pending = {}
+
+    def lookup(self, image_paths: List[str]) -> Dict[str, bool]:
+        """返回自上次记录后未变化的文件及其是否已有metadata；变化过或未记录的文件不在结果中"""
+        abs_paths = {image_path: os.path.abspath(image_path) for image_path in image_paths}
+        # 只查询本批文件（按主键查找），不扫描整张表；分块保持在SQLite的变量个数上限以内
+        unique_paths = list(set(abs_paths.values()))
+        rows = {}
+        for start in range(0, len(unique_paths), self.LOOKUP_CHUNK):
+            chunk = unique_paths[start:start + self.LOOKUP_CHUNK]
+            rows.update(
+                (path, (mtime_ns, size, has_meta))
+                for path, mtime_ns, size, has_meta in self._conn.execute(
+                    'SELECT path, mtime_ns, size, has_meta FROM metadata_index '
+                    f'WHERE path IN ({",".join("?" * len(chunk))})', chunk)
+            )
+        known = {}
+        for image_path in image_paths:
+            row = rows.get(abs_paths[image_path])
+            if row is None:
+                continue
+            try:
+                st = os.stat(image_path)
+            except OSError:
+                continue
+            if (st.st_mtime_ns, st.st_size) == row[:2]:
+                known[image_path] = bool(row[2])
+        return known
+
+    def update(self, results: Dict[str, bool]):
+        """记录文件当前状态（写入metadata后文件大小会变，需在写入后调用）"""
+        for image_path, has_meta in results.items():
+            try:
+                st = os.stat(image_path)
+            except OSError:
+                continue
+            self._pending[os.path.abspath(image_path)] = (st.st_mtime_ns, st.st_size, int(has_meta))
+        if len(self._pending) >= self.COMMIT_EVERY:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO metadata_index VALUES (?, ?, ?, ?)',
+                [(path, mtime_ns, size, has_meta) for path, (mtime_ns, size, has_meta) in self._pending.items()]
+            )
+        self._pending = {}
+
+    def close(self):
+        """提交尚未写入的记录并关闭数据库"""
+        self._flush()
+        self._conn.close()
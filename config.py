@@ -5,9 +5,27 @@ load_dotenv()
 
 # OpenAI配置
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+VISION_MODEL = 'gpt-4o-mini'  # 使用cost-effective的模型
+
+# 同时进行的Vision API请求数（分析是网络往返受限，并发可显著缩短总耗时）
+VISION_CONCURRENCY = int(os.getenv('VISION_CONCURRENCY', '8'))
+
+# 同时进行的metadata写入数（每个写入线程使用自己的常驻exiftool进程）
+METADATA_WRITE_CONCURRENCY = int(os.getenv('METADATA_WRITE_CONCURRENCY', '4'))
+
+# 发送给Vision API前的图片预处理：长边上限、JPEG质量，以及小于该字节数且尺寸合规的JPEG直接原样上传
+VISION_MAX_IMAGE_SIZE = int(os.getenv('VISION_MAX_IMAGE_SIZE', '1024'))
+VISION_JPEG_QUALITY = 85
+# 设置 VISION_HQ_RESIZE=1 时缩放使用更慢但更精细的LANCZOS滤镜（默认BILINEAR）
+VISION_HQ_RESIZE = os.getenv('VISION_HQ_RESIZE', '').lower() in ('1', 'true', 'yes')
+VISION_PASSTHROUGH_BYTES = 1_000_000
+
+# 分析结果缓存（按图片内容哈希），重新运行时内容未变的图片不再调用API
+ANALYSIS_CACHE_PATH = os.path.expanduser(
+    os.getenv('ANALYSIS_CACHE_PATH', '~/.cache/img-text-extractor/cache.sqlite'))
 
 # 支持的图片格式
-SUPPORTED_IMAGE_FORMATS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.heic', '.heif'}
+SUPPORTED_IMAGE_FORMATS = frozenset({'.jpg', '.jpeg', '.png', '.webp', '.gif', '.heic', '.heif'})
 
 # 图片识别提示词 - 优化为搜索友好的格式
 VISION_PROMPT = """分析这张图片并生成搜索友好的描述。请按以下格式输出：
@@ -53,6 +71,15 @@ SCREENSHOT_VISION_PROMPT = """仔细观察这张屏幕截图，准确提取其
 软件名称：微信
 文字内容：微信 通讯录 发现 我 张三 你好，我收到了 语音通话 视频通话 发送 表情 更多 10:30"""
 
+# --group-by-dir 模式：同一目录的图片每组最多这么多张合并为一次API请求
+VISION_GROUP_SIZE = int(os.getenv('VISION_GROUP_SIZE', '10'))
+
+# 多图请求的提示词：{count}为本组图片数，{prompt}为单张图片使用的提示词
+GROUP_VISION_PROMPT = """下面按顺序给出{count}张图片，请对每一张分别完成以下任务，各图片之间互不引用。
+每张图片的输出以单独一行 "=== 图片N ===" 开头（N为图片序号，从1开始）。
+
+{prompt}"""
+
 # Spotlight索引的metadata字段
 METADATA_FIELDS = {
     'description': 'ImageDescription',
@@ -11,17 +11,196 @@ import os
 import sys
 import json
 import base64
+import fnmatch
+import functools
+import hashlib
+import mmap
+import re
 import argparse
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 from dotenv import load_dotenv
 
+# orjson可选：请求体里是几MB的base64字符串时，序列化比标准库json快数倍
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # 加载.env文件
 load_dotenv()
 
+# 同时进行的上传请求数
+UPLOAD_CONCURRENCY = 8
+# GitHub对创建内容的请求有二级限速（每分钟不超过80次），超出会被临时封禁
+CONTENT_REQUESTS_PER_MINUTE = 80
+# sync_repository 默认忽略的文件（glob规则，'!' 开头为例外）：
+# .env 及 .env.local 等变体可能含有密钥，模板 .env.example 仍同步；
+# .github 下的workflow需要token带workflow权限才能提交，不同步
+DEFAULT_IGNORE_PATTERNS = ['.git', '.github', '.env', '.env.*', '!.env.example',
+                           '__pycache__', '*.pyc', '.DS_Store']
+# GitHub API拒绝超过100MB的文件，base64后的请求体还会再大1/3，超过50MB直接跳过
+MAX_UPLOAD_SIZE = 50_000_000
+
+
+def dump_json(data) -> bytes:
+    """序列化请求体（优先使用orjson）"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode('utf-8')
+
+
+def load_json(response: requests.Response):
+    """解析响应体（优先使用orjson）"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def read_file_base64(local_path: str) -> str:
+    """
+    读取文件并编码为base64
+    
+    通过mmap把文件映射后直接编码，不需要先把整个文件读成bytes副本。
+    """
+    size = os.path.getsize(local_path)
+    if size > MAX_UPLOAD_SIZE:
+        raise ValueError(f"file is {size / 1_000_000:.1f} MB, exceeds the {MAX_UPLOAD_SIZE // 1_000_000} MB upload limit")
+    if size == 0:
+        return ''
+    
+    with open(local_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return base64.b64encode(mapped).decode('ascii')
+
+
+def git_blob_sha(local_path: str) -> str:
+    """计算文件的git blob SHA-1（即 sha1("blob <长度>\\0" + 内容)，与GitHub树中的sha一致）"""
+    digest = hashlib.sha1(b'blob %d\0' % os.path.getsize(local_path))
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def filter_changed_files(file_mappings: List[Tuple[str, str]],
+                         remote_shas: Dict[str, str]) -> List[Tuple[str, str]]:
+    """去掉内容与远程相同的文件，只保留新增或修改过的文件"""
+    return [
+        (local_path, github_path) for local_path, github_path in file_mappings
+        if remote_shas.get(github_path) != git_blob_sha(local_path)
+    ]
+
+
+@functools.lru_cache(maxsize=1)
+def get_origin_repo_info() -> Tuple[str, str]:
+    """从git remote获取仓库信息（结果缓存，整个进程只调用一次git）"""
+    try:
+        result = subprocess.run(['git', 'remote', 'get-url', 'origin'], 
+                              capture_output=True, text=True, check=True)
+        remote_url = result.stdout.strip()
+        
+        # 解析不同格式的remote URL
+        if 'github.com' in remote_url:
+            if remote_url.startswith('git@'):
+                # SSH格式: git@github.com:owner/repo.git
+                parts = remote_url.split(':')[1].replace('.git', '').split('/')
+            elif remote_url.startswith('https://'):
+                # HTTPS格式: https://github.com/owner/repo.git
+                parts = remote_url.replace('https://github.com/', '').replace('.git', '').split('/')
+            else:
+                return "", ""
+            
+            if len(parts) >= 2:
+                return parts[0], parts[1]
+        
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        pass
+    
+    return "", ""
+
+
+def build_ignore_matcher(ignore_patterns: List[str]):
+    """
+    把glob风格的忽略规则编译成一个正则，返回判断相对路径是否应忽略的函数
+    
+    规则匹配整个相对路径或其中任意一级（如 '.git' 会忽略 .git/ 下的所有文件，
+    '*.pyc' 会忽略任意目录中的 .pyc 文件）。与 .gitignore 一样，'!' 开头的规则表示例外：
+    匹配整个相对路径或文件名的路径即使符合其他规则也不忽略（如 '!.env.example'）。
+    """
+    patterns = [pattern for pattern in ignore_patterns or [] if not pattern.startswith('!')]
+    exceptions = [pattern[1:] for pattern in ignore_patterns or [] if pattern.startswith('!')]
+    if not patterns:
+        return lambda relative_path: False
+    
+    regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+    exception_regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in exceptions)) if exceptions else None
+    
+    def is_ignored(relative_path: str) -> bool:
+        parts = relative_path.split('/')
+        if not (regex.match(relative_path) or any(regex.match(part) for part in parts)):
+            return False
+        return not (exception_regex and (exception_regex.match(relative_path) or exception_regex.match(parts[-1])))
+    
+    return is_ignored
+
+
+def iter_repository_files(root: str, is_ignored):
+    """
+    用os.scandir深度优先遍历目录，生成 (本地路径, 以/分隔的相对路径)
+    
+    在目录层面判断忽略规则，被忽略的目录不会再往下遍历。
+    """
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if is_ignored(relative_path):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relative_path)
+                elif entry.is_file():
+                    yield entry.path, relative_path
+
+
+class RateLimiter:
+    """线程安全的令牌桶限速器"""
+    
+    def __init__(self, rate: float, capacity: int):
+        """
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 令牌桶容量（允许的突发请求数）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """获取一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
 
 class GitHubSyncTool:
     """GitHub同步工具类"""
@@ -36,8 +215,12 @@ class GitHubSyncTool:
             repo_name: 仓库名称
         """
         self.token = token or os.getenv('GITHUB_TOKEN')
-        self.repo_owner = repo_owner or self._get_repo_info()[0]
-        self.repo_name = repo_name or self._get_repo_info()[1]
+        if not (repo_owner and repo_name):
+            origin_owner, origin_name = get_origin_repo_info()
+            repo_owner = repo_owner or origin_owner
+            repo_name = repo_name or origin_name
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
         
         if not self.token:
             raise ValueError("GitHub token is required. Set GITHUB_TOKEN environment variable or pass token parameter.")
@@ -48,39 +231,23 @@ class GitHubSyncTool:
             'Content-Type': 'application/json'
         }
         self.base_url = 'https://api.github.com'
-    
-    def _get_repo_info(self) -> Tuple[str, str]:
-        """从git remote获取仓库信息"""
-        try:
-            result = subprocess.run(['git', 'remote', 'get-url', 'origin'], 
-                                  capture_output=True, text=True, check=True)
-            remote_url = result.stdout.strip()
-            
-            # 解析不同格式的remote URL
-            if 'github.com' in remote_url:
-                if remote_url.startswith('git@'):
-                    # SSH格式: git@github.com:owner/repo.git
-                    parts = remote_url.split(':')[1].replace('.git', '').split('/')
-                elif remote_url.startswith('https://'):
-                    # HTTPS格式: https://github.com/owner/repo.git
-                    parts = remote_url.replace('https://github.com/', '').replace('.git', '').split('/')
-                else:
-                    return "", ""
-                
-                if len(parts) >= 2:
-                    return parts[0], parts[1]
-            
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            pass
         
-        return "", ""
+        # 共享Session复用TCP/TLS连接（keep-alive），避免每个请求重新握手
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        # 只访问api.github.com一个主机；连接数与上传线程数一致，
+        # pool_block让线程等待空闲连接，而不是临时新建连接、用完即丢弃（每次都要重新握手）
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_CONCURRENCY,
+                              pool_block=True, max_retries=retry)
+        self.session.mount('https://', adapter)
     
     def test_connection(self) -> bool:
         """测试GitHub API连接"""
         try:
-            response = requests.get(f'{self.base_url}/user', headers=self.headers)
+            response = self.session.get(f'{self.base_url}/user')
             if response.status_code == 200:
-                user_info = response.json()
+                user_info = load_json(response)
                 print(f"✅ Connected to GitHub as: {user_info.get('login', 'Unknown')}")
                 return True
             else:
@@ -96,16 +263,39 @@ class GitHubSyncTool:
         params = {'ref': branch}
         
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.session.get(url, params=params)
             if response.status_code == 200:
-                return response.json().get('sha')
+                return load_json(response).get('sha')
             return None
         except Exception:
             return None
     
+    def get_tree_shas(self, branch: str = 'main') -> Optional[Dict[str, str]]:
+        """
+        一次请求获取分支（或tree SHA）上所有文件的blob SHA
+        
+        Returns:
+            {文件路径: SHA}；分支不存在时返回空字典，获取失败或结果被截断时返回None
+        """
+        url = f'{self.base_url}/repos/{self.repo_owner}/{self.repo_name}/git/trees/{branch}'
+        
+        try:
+            response = self.session.get(url, params={'recursive': '1'})
+            if response.status_code == 404:
+                return {}
+            if response.status_code != 200:
+                return None
+            tree = load_json(response)
+            if tree.get('truncated'):
+                return None
+            return {item['path']: item['sha'] for item in tree.get('tree', []) if item.get('type') == 'blob'}
+        except Exception:
+            return None
+    
     def upload_file(self, local_path: str, github_path: str, 
                    commit_message: str, branch: str = 'main',
-                   update_if_exists: bool = True) -> bool:
+                   update_if_exists: bool = True,
+                   known_shas: Optional[Dict[str, str]] = None) -> bool:
         """
         上传或更新文件到GitHub
         
@@ -115,6 +305,7 @@ class GitHubSyncTool:
             commit_message: 提交信息
             branch: 目标分支
             update_if_exists: 如果文件已存在是否更新
+            known_shas: 预先获取的 {路径: SHA}，提供时不再逐个查询文件SHA
         """
         if not os.path.exists(local_path):
             print(f"❌ Local file not found: {local_path}")
@@ -122,14 +313,16 @@ class GitHubSyncTool:
         
         # 读取文件内容并编码
         try:
-            with open(local_path, 'rb') as f:
-                content = base64.b64encode(f.read()).decode('utf-8')
+            content = read_file_base64(local_path)
         except Exception as e:
             print(f"❌ Failed to read file {local_path}: {e}")
             return False
         
         # 检查文件是否已存在
-        existing_sha = self.get_file_sha(github_path, branch)
+        if known_shas is not None:
+            existing_sha = known_shas.get(github_path)
+        else:
+            existing_sha = self.get_file_sha(github_path, branch)
         
         # 构建API请求
         url = f'{self.base_url}/repos/{self.repo_owner}/{self.repo_name}/contents/{github_path}'
@@ -150,17 +343,20 @@ class GitHubSyncTool:
             action = "Created"
         
         try:
-            response = requests.put(url, headers=self.headers, json=data)
+            # 分支头恰好被其他客户端更新时返回409冲突，稍后重试即可
+            for attempt in range(3):
+                response = self.session.put(url, data=dump_json(data))
+                if response.status_code != 409:
+                    break
+                time.sleep(0.5 * (attempt + 1))
             
             if response.status_code in [200, 201]:
-                result = response.json()
+                result = load_json(response)
                 commit_url = result['commit']['html_url']
-                print(f"✅ {action} {github_path}")
-                print(f"   Commit: {commit_url}")
+                print(f"✅ {action} {github_path}\n   Commit: {commit_url}")
                 return True
             else:
-                print(f"❌ Failed to upload {github_path}: {response.status_code}")
-                print(f"   Response: {response.text}")
+                print(f"❌ Failed to upload {github_path}: {response.status_code}\n   Response: {response.text}")
                 return False
                 
         except Exception as e:
@@ -172,21 +368,36 @@ class GitHubSyncTool:
         """
         批量上传文件
         
+        contents API每个文件都会在分支上产生一个commit，同一分支的并发写入会互相冲突，
+        因此逐个顺序上传；需要并发上传时使用 commit_files。
+        
         Args:
             file_mappings: [(local_path, github_path), ...] 文件映射列表
             commit_message: 提交信息
             branch: 目标分支
         """
+        # 一次获取整棵树的SHA，代替逐个文件查询
+        known_shas = self.get_tree_shas(branch)
+        
+        # 跳过内容没有变化的文件
+        if known_shas:
+            changed = filter_changed_files(file_mappings, known_shas)
+            if len(changed) < len(file_mappings):
+                print(f"⏭️  Skipping {len(file_mappings) - len(changed)} unchanged files")
+            file_mappings = changed
+        
         success_count = 0
         total_count = len(file_mappings)
         
         print(f"📤 Starting batch upload of {total_count} files...")
+        limiter = RateLimiter(CONTENT_REQUESTS_PER_MINUTE / 60, UPLOAD_CONCURRENCY)
         
         for i, (local_path, github_path) in enumerate(file_mappings, 1):
+            limiter.acquire()
             print(f"\n[{i}/{total_count}] Uploading {github_path}...")
-            
-            if self.upload_file(local_path, github_path, 
-                              f"{commit_message} ({i}/{total_count})", branch):
+            if self.upload_file(local_path, github_path,
+                                f"{commit_message} ({i}/{total_count})", branch,
+                                known_shas=known_shas):
                 success_count += 1
         
         print(f"\n📊 Upload Summary:")
@@ -195,6 +406,113 @@ class GitHubSyncTool:
         
         return success_count == total_count
     
+    def create_blob(self, local_path: str) -> Optional[str]:
+        """上传文件内容为git blob，返回blob SHA"""
+        url = f'{self.base_url}/repos/{self.repo_owner}/{self.repo_name}/git/blobs'
+        
+        try:
+            content = read_file_base64(local_path)
+            response = self.session.post(url, data=dump_json({'content': content, 'encoding': 'base64'}))
+            if response.status_code == 201:
+                return load_json(response)['sha']
+            print(f"❌ Failed to create blob for {local_path}: {response.status_code}")
+            return None
+        except Exception as e:
+            print(f"❌ Blob upload error for {local_path}: {e}")
+            return None
+    
+    def commit_files(self, file_mappings: List[Tuple[str, str]],
+                     commit_message: str, branch: str = 'main') -> bool:
+        """
+        通过git数据API把多个文件提交为一个commit
+        
+        上传N个blob后只需创建一个tree、一个commit并更新分支引用，
+        不像contents API那样每个文件产生一个commit。
+        
+        Args:
+            file_mappings: [(local_path, github_path), ...] 文件映射列表
+            commit_message: 提交信息
+            branch: 目标分支
+        """
+        repo_url = f'{self.base_url}/repos/{self.repo_owner}/{self.repo_name}'
+        
+        # 1. 获取分支当前的commit和tree
+        response = self.session.get(f'{repo_url}/git/ref/heads/{branch}')
+        if response.status_code != 200:
+            # 空仓库无法使用git数据API，退回到逐个文件上传
+            print(f"⚠️  Branch {branch} not found ({response.status_code}), falling back to per-file upload")
+            return self.batch_upload(file_mappings, commit_message, branch)
+        head_sha = load_json(response)['object']['sha']
+        
+        response = self.session.get(f'{repo_url}/git/commits/{head_sha}')
+        if response.status_code != 200:
+            print(f"❌ Failed to read commit {head_sha}: {response.status_code}")
+            return False
+        base_tree = load_json(response)['tree']['sha']
+        
+        # 2. 跳过内容没有变化的文件
+        remote_shas = self.get_tree_shas(base_tree)
+        if remote_shas:
+            changed = filter_changed_files(file_mappings, remote_shas)
+            if len(changed) < len(file_mappings):
+                print(f"⏭️  Skipping {len(file_mappings) - len(changed)} unchanged files")
+            file_mappings = changed
+        if not file_mappings:
+            print(f"✅ {branch} is already up to date")
+            return True
+        
+        # 3. 并发上传blob
+        total_count = len(file_mappings)
+        print(f"📤 Uploading {total_count} blobs...")
+        limiter = RateLimiter(CONTENT_REQUESTS_PER_MINUTE / 60, UPLOAD_CONCURRENCY)
+        
+        def create_one(local_path: str) -> Optional[str]:
+            limiter.acquire()
+            return self.create_blob(local_path)
+        
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            blob_shas = list(executor.map(create_one, [local_path for local_path, _ in file_mappings]))
+        
+        if None in blob_shas:
+            failed = blob_shas.count(None)
+            print(f"❌ {failed}/{total_count} blobs failed to upload, commit aborted")
+            return False
+        
+        # 4. 基于当前tree创建新tree
+        tree = [
+            {
+                'path': github_path,
+                'mode': '100755' if os.access(local_path, os.X_OK) else '100644',
+                'type': 'blob',
+                'sha': blob_sha
+            }
+            for (local_path, github_path), blob_sha in zip(file_mappings, blob_shas)
+        ]
+        response = self.session.post(f'{repo_url}/git/trees', data=dump_json({'base_tree': base_tree, 'tree': tree}))
+        if response.status_code != 201:
+            print(f"❌ Failed to create tree: {response.status_code}\n   Response: {response.text}")
+            return False
+        tree_sha = load_json(response)['sha']
+        
+        # 5. 创建commit并移动分支引用
+        response = self.session.post(f'{repo_url}/git/commits', data=dump_json({
+            'message': commit_message,
+            'tree': tree_sha,
+            'parents': [head_sha]
+        }))
+        if response.status_code != 201:
+            print(f"❌ Failed to create commit: {response.status_code}\n   Response: {response.text}")
+            return False
+        commit = load_json(response)
+        
+        response = self.session.patch(f'{repo_url}/git/refs/heads/{branch}', data=dump_json({'sha': commit['sha']}))
+        if response.status_code != 200:
+            print(f"❌ Failed to update branch {branch}: {response.status_code}\n   Response: {response.text}")
+            return False
+        
+        print(f"✅ Committed {total_count} files to {branch}\n   Commit: {commit.get('html_url', commit['sha'])}")
+        return True
+    
     def sync_repository(self, local_dir: str = ".", 
                        ignore_patterns: List[str] = None,
                        commit_message: str = None) -> bool:
@@ -207,32 +525,22 @@ class GitHubSyncTool:
             commit_message: 提交信息
         """
         if ignore_patterns is None:
-            ignore_patterns = ['.git', '.env', '__pycache__', '*.pyc', '.DS_Store']
+            ignore_patterns = DEFAULT_IGNORE_PATTERNS
         
         if commit_message is None:
             commit_message = f"Auto-sync repository - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         
         local_path = Path(local_dir).resolve()
         file_mappings = []
+        is_ignored = build_ignore_matcher(ignore_patterns)
         
-        # 扫描本地文件
-        for file_path in local_path.rglob('*'):
-            if file_path.is_file():
-                relative_path = file_path.relative_to(local_path)
-                
-                # 检查是否应该忽略
-                should_ignore = False
-                for pattern in ignore_patterns:
-                    if pattern in str(relative_path):
-                        should_ignore = True
-                        break
-                
-                if not should_ignore:
-                    github_path = str(relative_path).replace('\\', '/')
-                    file_mappings.append((str(file_path), github_path))
+        # 扫描本地文件（被忽略的目录整棵跳过，不会进入 .git 等目录）
+        for file_path, github_path in iter_repository_files(str(local_path), is_ignored):
+            file_mappings.append((file_path, github_path))
+        file_mappings.sort(key=lambda mapping: mapping[1])
         
         print(f"🔍 Found {len(file_mappings)} files to sync")
-        return self.batch_upload(file_mappings, commit_message)
+        return self.commit_files(file_mappings, commit_message)
 
 
 def setup_github_token():
@@ -1,46 +1,457 @@
 #!/usr/bin/env python3
 import argparse
+import io
+import logging
 import os
+import queue
+import sqlite3
+import stat
 import sys
-from pathlib import Path
-from tqdm import tqdm
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from logging.handlers import QueueHandler, QueueListener
+from typing import Iterator, Optional
 
-from vision import ImageAnalyzer
-from metadata import MetadataWriter
-from config import SUPPORTED_IMAGE_FORMATS
+from cache import AnalysisCache, MetadataIndex, file_sha1
+from config import SUPPORTED_IMAGE_FORMATS, VISION_CONCURRENCY, VISION_GROUP_SIZE, METADATA_WRITE_CONCURRENCY
 
 
-def find_images(path_input: str, recursive: bool = True) -> list:
-    """查找目录中的图片文件或处理单个图片文件"""
-    image_files = []
-    path = Path(path_input)
+# 最后的搜索示例只显示6个关键词，收集到这么多就不再继续累积
+KEYWORD_EXAMPLE_BUDGET = 32
+
+# 递归扫描单个目录树时同时进行的目录读取数
+SCAN_WORKERS = 16
+
+# 边扫描边处理时每攒够这么多张图片就交给后续流程（批量检查metadata后提交分析）
+STREAM_BATCH_SIZE = 200
+
+# 预先构造小写后缀元组，str.endswith(tuple) 在C层完成匹配
+_IMAGE_SUFFIXES = tuple(sorted(ext.lower() for ext in SUPPORTED_IMAGE_FORMATS))
+# 提示信息中按固定顺序列出支持的格式（集合本身无序）
+_SUPPORTED_FORMATS_TEXT = ', '.join(_IMAGE_SUFFIXES)
+
+
+def _is_image_name(name: str) -> bool:
+    """根据文件名判断是否为支持的图片格式（与Path.suffix语义一致）"""
+    # rfind > 0 排除 ".jpg" 这类没有主干名的隐藏文件，Path.suffix 对其返回空串
+    return name.lower().endswith(_IMAGE_SUFFIXES) and name.rfind('.') > 0
+
+
+def _list_directory(directory: str) -> tuple:
+    """读取单个目录，返回 (子目录列表, 图片列表)；DirEntry自带类型缓存，避免逐个创建Path对象"""
+    subdirs = []
+    images = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            # 先做不需要系统调用的文件名检查；文件系统不提供d_type时 is_file() 才需要stat
+            elif _is_image_name(entry.name) and entry.is_file():
+                images.append(entry.path)
+    return subdirs, images
+
+
+def _iter_directory(directory: str, recursive: bool) -> Iterator[str]:
+    """遍历目录，每读完一个目录就产出其中的图片
     
-    if not path.exists():
-        raise FileNotFoundError(f"路径不存在: {path_input}")
+    递归时由线程池并发读取子目录：在NAS/SMB等高延迟存储上，每个线程都能保持一个目录读取在途，
+    新发现的子目录随即提交，不必等整层读完。
+    """
+    # 根目录的错误（如无权限）直接抛出
+    subdirs, images = _list_directory(directory)
+    yield from images
+    if not recursive or not subdirs:
+        return
+    
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {executor.submit(_list_directory, subdir) for subdir in subdirs}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        subdirs, images = future.result()
+                    except PermissionError:
+                        # 与rglob一致：跳过无权限访问的子目录
+                        continue
+                    pending.update(executor.submit(_list_directory, subdir) for subdir in subdirs)
+                    yield from images
+        finally:
+            # 调用方提前停止迭代时不再读取剩余目录
+            for future in pending:
+                future.cancel()
+
+
+def iter_images(path_input: str, recursive: bool = True) -> Iterator[str]:
+    """边扫描边产出图片的绝对路径（顺序不固定），不必等整个目录树扫描完成
+    
+    路径在入口处规范化为绝对路径字符串，之后各处只做字符串操作，不必再转换或求绝对路径。
+    路径不存在、格式不支持等错误在调用时立即抛出，而不是等到开始迭代。
+    """
+    path = os.path.abspath(path_input)
+    
+    # 一次stat同时得到存在性和类型
+    try:
+        mode = os.stat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        raise FileNotFoundError(f"路径不存在: {path_input}") from None
     
     # 处理单个图片文件
-    if path.is_file():
-        if path.suffix.lower() in SUPPORTED_IMAGE_FORMATS:
-            return [str(path)]
-        else:
-            raise ValueError(f"不支持的图片格式: {path.suffix}。支持的格式: {', '.join(SUPPORTED_IMAGE_FORMATS)}")
+    if stat.S_ISREG(mode):
+        if _is_image_name(os.path.basename(path)):
+            return iter((path,))
+        raise ValueError(f"不支持的图片格式: {os.path.splitext(path)[1]}。支持的格式: {_SUPPORTED_FORMATS_TEXT}")
     
     # 处理目录
-    if not path.is_dir():
+    if not stat.S_ISDIR(mode):
         raise ValueError(f"路径既不是文件也不是目录: {path_input}")
     
-    # 根据是否递归选择搜索方式
-    if recursive:
-        pattern = "**/*"
-        files = path.rglob(pattern)
+    return _iter_directory(path, recursive)
+
+
+def find_images(path_input: str, recursive: bool = True) -> list:
+    """查找目录中的图片文件或处理单个图片文件，返回排序后的列表"""
+    return sorted(iter_images(path_input, recursive))
+
+
+def find_images_in_paths(paths: list, recursive: bool = True) -> list:
+    """并发扫描多个路径，返回与输入顺序一致的 [(路径, 图片列表), ...]
+    
+    目录遍历受stat IO限制，多个根目录（尤其位于不同磁盘/网络存储时）并发扫描可以重叠等待时间。
+    """
+    if len(paths) <= 1:
+        return [(path, find_images(path, recursive)) for path in paths]
+    
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+        results = executor.map(lambda path: find_images(path, recursive), paths)
+        return list(zip(paths, results))
+
+
+def iter_image_batches(paths: list, path_resolver, recursive: bool = True,
+                       batch_size: Optional[int] = None) -> Iterator[list]:
+    """按输入顺序边扫描边产出图片批次，每批内按路径排序，并登记到 path_resolver
+    
+    调用方可以在后续目录还在扫描时就开始分析已找到的图片。输入路径有重叠时同一文件只产出一次。
+    所有输入路径在调用时即校验，错误不会等到处理了一部分图片之后才出现。
+    """
+    if batch_size is None:
+        batch_size = STREAM_BATCH_SIZE
+    scans = [(path, iter_images(path, recursive)) for path in paths]
+    
+    def generate():
+        seen = set()
+        for path, images in scans:
+            batch = []
+            for image_file in images:
+                if image_file in seen:
+                    continue
+                seen.add(image_file)
+                batch.append(image_file)
+                if len(batch) >= batch_size:
+                    batch.sort()
+                    path_resolver.add_scan_result(path, batch)
+                    yield batch
+                    batch = []
+            if batch:
+                batch.sort()
+                path_resolver.add_scan_result(path, batch)
+                yield batch
+    
+    return generate()
+
+
+def group_duplicates(image_files: list, digests: Optional[dict] = None) -> dict:
+    """按内容哈希分组，返回 {代表图片: [内容相同的其他图片, ...]}，只包含有重复的组
+    
+    传入 digests 时把算出的 {图片: SHA-1} 记录进去，之后查询分析缓存时不必再次读取文件。
+    """
+    def digest(image_file):
+        try:
+            return file_sha1(image_file)
+        except OSError:
+            # 读取失败的文件不参与去重，交给后续分析报告错误
+            return None
+    
+    # 同一文件可能因输入路径重叠出现多次，只按不同路径分组
+    image_files = list(dict.fromkeys(image_files))
+    groups = {}
+    # 哈希计算受磁盘IO限制，并发读取
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for image_file, sha in zip(image_files, executor.map(digest, image_files)):
+            if sha is not None:
+                groups.setdefault(sha, []).append(image_file)
+                if digests is not None:
+                    digests[image_file] = sha
+    return {group[0]: group[1:] for group in groups.values() if len(group) > 1}
+
+
+def format_multiline_field(field_name: str, content: str, max_length: int = 100) -> str:
+    """格式化多行字段，保持缩进对齐，返回用于显示的文本"""
+    if not content:
+        return ''
+    
+    lines = content.strip().split('\n')
+    if len(lines) == 1:
+        # 单行内容，检查长度
+        if len(content) > max_length:
+            content = content[:max_length-3] + "..."
+        return f"    {field_name}: {content}\n"
+    
+    # 多行内容，保持缩进
+    indent = " " * (len(field_name) + 6)  # 对齐到冒号后面
+    parts = [f"    {field_name}: {lines[0]}\n"]
+    parts.extend(f"{indent}{line.strip()}\n" for line in lines[1:] if line.strip())
+    return ''.join(parts)
+
+
+def analyze_with_cache(analyzer, cache, image_file: str, screenshot_mode: bool, refresh: bool = False,
+                       digests: Optional[dict] = None):
+    """先按内容哈希查询本地缓存，未命中时调用Vision API并写入缓存；refresh 时不读缓存，只更新
+    
+    digests 为已经算好的 {图片: SHA-1}（如 --dedup 分组时），命中时不再读取文件。
+    """
+    if cache is None:
+        return analyzer.analyze_image(image_file, screenshot_mode)
+    
+    sha = digests.get(image_file) if digests else None
+    if sha is None:
+        try:
+            sha = file_sha1(image_file)
+        except OSError:
+            # 读取失败交给analyze_image报告具体错误
+            return analyzer.analyze_image(image_file, screenshot_mode)
+    
+    description = None if refresh else cache.get(sha, screenshot_mode)
+    if description is None:
+        description = analyzer.analyze_image(image_file, screenshot_mode)
+        if description:
+            cache.put(sha, screenshot_mode, description)
+    return description
+
+
+def analyze_group_with_cache(analyzer, cache, image_files: list, screenshot_mode: bool,
+                             refresh: bool = False, digests: Optional[dict] = None) -> dict:
+    """一组图片中缓存未命中的部分用一次请求分析，返回 {图片: 描述}（分析失败的图片不在结果中）"""
+    results = {}
+    shas = {}
+    misses = []
+    for image_file in image_files:
+        if cache is not None:
+            try:
+                shas[image_file] = (digests.get(image_file) if digests else None) or file_sha1(image_file)
+            except OSError:
+                pass
+            else:
+                description = None if refresh else cache.get(shas[image_file], screenshot_mode)
+                if description is not None:
+                    results[image_file] = description
+                    continue
+        misses.append(image_file)
+    
+    if misses:
+        for image_file, description in analyzer.analyze_group(misses, screenshot_mode).items():
+            results[image_file] = description
+            if image_file in shas:
+                cache.put(shas[image_file], screenshot_mode, description)
+    return results
+
+
+def submit_group(executor, analyzer, cache, group: list, screenshot_mode: bool, refresh: bool = False,
+                 digests: Optional[dict] = None):
+    """提交一组图片的合并分析，返回 (整组的Future, {每张图片的Future: 图片信息})
+    
+    每张图片的Future在整组完成时得到各自的描述（失败为None），结果处理与逐张分析时相同。
+    group 中的元素为 (图片路径, 相对路径, base_dir)。
+    """
+    group_future = executor.submit(analyze_group_with_cache, analyzer, cache,
+                                   [entry[0] for entry in group], screenshot_mode, refresh, digests)
+    image_futures = {Future(): entry for entry in group}
+    
+    def resolve(done):
+        for image_future, (image_file, _, _) in image_futures.items():
+            if done.cancelled():
+                image_future.cancel()
+            elif not image_future.set_running_or_notify_cancel():
+                continue
+            elif done.exception() is not None:
+                image_future.set_exception(done.exception())
+            else:
+                image_future.set_result(done.result().get(image_file))
+    
+    group_future.add_done_callback(resolve)
+    return group_future, image_futures
+
+
+def format_metadata_preview(description: str, parsed: dict, keywords: list, screenshot_mode: bool) -> str:
+    """生成将要写入的metadata字段预览文本"""
+    keywords_str = ', '.join(keywords) if keywords else ''
+    
+    # 根据模式构建搜索优化的短描述
+    search_description_parts = []
+    if screenshot_mode:
+        # 截图模式：优先显示文字内容和应用信息
+        if 'summary' in parsed:
+            search_description_parts.append(parsed['summary'])
+        if 'text_content' in parsed:
+            text_content = parsed['text_content']
+            if len(text_content) > 100:
+                text_content = text_content[:100] + "..."
+            search_description_parts.append(text_content)
+        if 'app_info' in parsed:
+            search_description_parts.append(parsed['app_info'])
     else:
-        files = path.iterdir()
+        # 普通模式：原有逻辑
+        if 'summary' in parsed:
+            search_description_parts.append(parsed['summary'])
+        if 'objects' in parsed:
+            search_description_parts.append(parsed['objects'])
+        if 'scene' in parsed:
+            search_description_parts.append(parsed['scene'])
+    search_description = ' '.join(search_description_parts)
+    
+    out = io.StringIO()
+    out.write("  📝 将要写入的metadata字段:\n")
+    
+    # 显示实际的metadata字段和值（处理换行，保持缩进对齐）
+    if search_description:
+        search_display = search_description.replace('\n', ' ').strip()
+        if len(search_display) > 80:
+            search_display = search_display[:77] + "..."
+        out.write(f"    Subject: {search_display}\n")
+        out.write(f"    Caption-Abstract: {search_display}\n")
+    
+    out.write(format_multiline_field("ImageDescription", description, 120))
+    out.write(format_multiline_field("UserComment", description, 120))
+    
+    if keywords_str:
+        # 限制关键词显示长度
+        if len(keywords_str) > 80:
+            keywords_display = keywords_str[:77] + "..."
+        else:
+            keywords_display = keywords_str
+        out.write(f"    XMP:Description: {keywords_display}\n")
+        out.write(f"    Keywords: {keywords_display}\n")
+        out.write(f"    XMP:Subject: {keywords_display}\n")
+    
+    # 根据模式显示特殊字段
+    if screenshot_mode:
+        if 'text_content' in parsed and parsed['text_content']:
+            out.write(format_multiline_field("XMP:Title", parsed['text_content'], 100))
+            out.write(f"    Creator: {parsed['text_content'][:50]}{'...' if len(parsed['text_content']) > 50 else ''}\n")
+        if 'app_info' in parsed and parsed['app_info']:
+            out.write(f"    Software: {parsed['app_info']}\n")
+    else:
+        if 'text' in parsed and parsed['text'] and parsed['text'] != '无':
+            out.write(format_multiline_field("XMP:Title", parsed['text'], 80))
+    
+    return out.getvalue()
+
+
+class PathResolver:
+    """根据命令行输入的路径计算图片的显示路径和基准目录
+    
+    扫描结果通过 add_scan_result 登记后按字典直接查询；未登记的文件退回到前缀匹配。
+    输入路径的绝对路径和类型只在构造时计算一次，按长度降序排列使最长匹配优先。
+    """
+    
+    def __init__(self, paths: list):
+        entries = []
+        for path in paths:
+            path_abs = os.path.abspath(path)
+            # 目录匹配时带上分隔符，避免 /foo 误匹配 /foobar 下的文件
+            prefix = path_abs.rstrip(os.sep) + os.sep
+            entries.append((path_abs, prefix, path, os.path.isfile(path_abs)))
+        # 每个输入路径的类型只stat一次，扫描和重新索引时直接复用
+        self._is_file = {path: is_file for _, _, path, is_file in entries}
+        entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+        self._entries = entries
+        self._scanned = {}
+    
+    def is_file(self, path: str) -> bool:
+        """输入路径是否为单个文件（构造时已确定）"""
+        return self._is_file[path]
+    
+    def add_scan_result(self, path: str, images: list):
+        """登记某个输入路径扫描到的图片，之后查询不再需要前缀匹配"""
+        if self._is_file[path]:
+            base_dir = os.path.dirname(path)
+            for image_file in images:
+                self._scanned.setdefault(image_file, (os.path.basename(image_file), base_dir))
+            return
+        
+        # 扫描结果都是以输入目录绝对路径加分隔符开头的绝对路径，直接切片即可得到相对路径
+        prefix = os.path.join(os.path.abspath(path), '')
+        for image_file in images:
+            if image_file.startswith(prefix):
+                relative_path = image_file[len(prefix):]
+            else:
+                relative_path = os.path.relpath(image_file, path)
+            self._scanned.setdefault(image_file, (relative_path, path))
+    
+    def resolve(self, image_file: str) -> tuple:
+        """找到图片文件所属的输入路径，返回 (用于显示的相对路径, 基准目录)"""
+        scanned = self._scanned.get(image_file)
+        if scanned is not None:
+            return scanned
+        
+        # 每张图片只计算一次绝对路径，相对路径形式的输入也能正确匹配
+        image_abs = os.path.abspath(image_file)
+        for path_abs, prefix, path, is_file in self._entries:
+            if is_file:
+                # 如果是文件，直接使用文件名
+                if image_abs == path_abs:
+                    return os.path.basename(image_file), os.path.dirname(path)
+            elif image_abs.startswith(prefix):
+                # 如果是目录，计算相对路径
+                return image_abs[len(prefix):], path
+        return image_file, None
+    
+    def rel(self, image_file: str) -> str:
+        """返回用于显示的相对路径"""
+        return self.resolve(image_file)[0]
+
+
+class TqdmLoggingHandler(logging.Handler):
+    """通过 tqdm.write 输出日志，与进度条交替时不会打乱进度条"""
+    
+    def __init__(self):
+        super().__init__()
+        from tqdm import tqdm
+        self._write = tqdm.write
     
-    for file in files:
-        if file.is_file() and file.suffix.lower() in SUPPORTED_IMAGE_FORMATS:
-            image_files.append(str(file))
+    def emit(self, record):
+        try:
+            self._write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def start_log_listener() -> QueueListener:
+    """让vision模块的日志经队列由后台线程通过tqdm输出
     
-    return sorted(image_files)
+    分析线程记录日志时只需入队，不在请求路径上争抢stdout锁。结束时需调用 stop_log_listener()，
+    把剩余日志写完并恢复vision日志的默认设置（作为库使用时日志照常向上传递）。
+    """
+    log_queue = queue.SimpleQueue()
+    handler = TqdmLoggingHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    logger = logging.getLogger('vision')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(QueueHandler(log_queue))
+    return listener
+
+
+def stop_log_listener(listener: QueueListener):
+    """写完队列中剩余的日志，并撤掉 start_log_listener() 对vision日志的设置"""
+    logger = logging.getLogger('vision')
+    for handler in logger.handlers[:]:
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            logger.removeHandler(handler)
+    logger.propagate = True
+    logger.setLevel(logging.NOTSET)
+    listener.stop()
 
 
 def main():
@@ -53,6 +464,10 @@ def main():
   python main.py ~/Pictures/image.jpg                 # 处理单个图片文件
   python main.py ~/Pictures --no-recursive            # 仅处理当前目录，不包括子目录
   python main.py ~/Pictures --dry-run                 # 预览模式，不实际写入
+  python main.py ~/Pictures --concurrency 4           # 限制同时进行的识别请求数
+  python main.py ~/Pictures --verbose                 # 显示每张图片写入的metadata字段
+  python main.py ~/Pictures --dedup                   # 内容相同的图片只识别一次
+  python main.py ~/Screenshots --group-by-dir         # 同一目录的图片合并请求，减少API调用次数
   python main.py ~/Pictures --verify                  # 验证已写入的metadata
   python main.py ~/Screenshots --screenshot-mode      # 截图模式，专门识别文字内容
   python main.py ~/Screenshots/screen.png --screenshot-mode --dry-run  # 预览单个截图识别效果
@@ -89,7 +504,7 @@ def main():
     parser.add_argument(
         '--force',
         action='store_true',
-        help='强制重新处理已有metadata的图片'
+        help='强制重新处理已有metadata的图片（同时忽略本地缓存的识别结果，重新调用API）'
     )
     
     parser.add_argument(
@@ -104,55 +519,92 @@ def main():
         help='截图模式：专门针对屏幕截图优化，重点识别文字内容和UI元素'
     )
     
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='显示每张图片将要写入的metadata字段（--dry-run 时总是显示）'
+    )
+    
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=VISION_CONCURRENCY,
+        help=f'同时进行的图片识别请求数（默认{VISION_CONCURRENCY}，可通过 VISION_CONCURRENCY 环境变量设置）'
+    )
+    
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help='内容完全相同的图片只调用一次API，描述复用到所有副本'
+    )
+    
+    parser.add_argument(
+        '--group-by-dir',
+        action='store_true',
+        help=f'同一目录的图片每{VISION_GROUP_SIZE}张合并为一次识别请求（适合相册、连续截图；'
+             f'可通过 VISION_GROUP_SIZE 环境变量设置）'
+    )
+    
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='不使用本地缓存：所有图片都重新检查metadata并调用API识别'
+    )
+    
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error('--concurrency 必须大于等于1')
     
+    log_listener = start_log_listener()
     try:
         # 查找图片文件
         print("🔍 正在扫描图片文件...")
-        all_image_files = []
-        for path in args.paths:
-            path_obj = Path(path)
-            if path_obj.is_file():
-                print(f"  📄 处理文件: {path}")
-                file_images = find_images(path, not args.no_recursive)
-                all_image_files.extend(file_images)
-                print(f"     找到 {len(file_images)} 张图片")
-            else:
-                print(f"  📂 扫描目录: {path}")
-                dir_images = find_images(path, not args.no_recursive)
-                all_image_files.extend(dir_images)
-                print(f"     找到 {len(dir_images)} 张图片")
-        
-        if not all_image_files:
-            print("❌ 未找到支持的图片文件")
-            print(f"支持的格式: {', '.join(SUPPORTED_IMAGE_FORMATS)}")
-            return 1
-        
-        print(f"✅ 总共找到 {len(all_image_files)} 张图片")
-        image_files = all_image_files
+        # 输入路径的绝对路径和类型只计算一次；扫描时已知每张图片属于哪个输入路径，直接登记
+        path_resolver = PathResolver(args.paths)
+        # 验证和去重需要完整的文件列表，先扫描完；其余情况边扫描边处理，分析请求与目录遍历重叠进行
+        streaming = not (args.verify or args.dedup)
+        if streaming:
+            image_batches = iter_image_batches(args.paths, path_resolver, not args.no_recursive)
+            for path in args.paths:
+                if path_resolver.is_file(path):
+                    print(f"  📄 处理文件: {path}")
+                else:
+                    print(f"  📂 扫描目录: {path}")
+        else:
+            all_image_files = []
+            for path, path_images in find_images_in_paths(args.paths, not args.no_recursive):
+                if path_resolver.is_file(path):
+                    print(f"  📄 处理文件: {path}")
+                else:
+                    print(f"  📂 扫描目录: {path}")
+                path_resolver.add_scan_result(path, path_images)
+                all_image_files.extend(path_images)
+                print(f"     找到 {len(path_images)} 张图片")
+            
+            if not all_image_files:
+                print("❌ 未找到支持的图片文件")
+                print(f"支持的格式: {_SUPPORTED_FORMATS_TEXT}")
+                return 1
+            
+            print(f"✅ 总共找到 {len(all_image_files)} 张图片")
+            # 输入路径有重叠时同一文件只处理一次，避免并发写入同一个文件
+            image_files = list(dict.fromkeys(all_image_files))
+            image_batches = [image_files]
         
-        # 初始化工具
+        # 初始化工具（较重的依赖在真正需要时才导入，--help 等不必加载）
+        from tqdm import tqdm
+        from metadata import MetadataWriter
         metadata_writer = MetadataWriter()
         
         if args.verify:
             # 验证模式
             print("\n🔍 正在验证metadata...")
-            for image_file in tqdm(image_files, desc="验证进度"):
-                metadata = metadata_writer.verify_metadata(image_file)
-                # 找到图片文件属于哪个路径，用于计算相对路径
-                relative_path = image_file
-                for path in args.paths:
-                    path_abs = os.path.abspath(path)
-                    if Path(path).is_file():
-                        # 如果是文件，直接使用文件名
-                        if os.path.abspath(image_file) == path_abs:
-                            relative_path = os.path.basename(image_file)
-                            break
-                    else:
-                        # 如果是目录，计算相对路径
-                        if image_file.startswith(path_abs):
-                            relative_path = os.path.relpath(image_file, path)
-                            break
+            # 一次性批量读取，避免逐张启动exiftool
+            metadata_map = metadata_writer.verify_metadata_batch(image_files)
+            for image_file in image_files:
+                metadata = metadata_map.get(image_file)
+                # 显示相对路径（扫描时已登记，直接查表）
+                relative_path = path_resolver.rel(image_file)
                 
                 if metadata:
                     print(f"✅ {relative_path}: 已有metadata")
@@ -169,171 +621,195 @@ def main():
         success_count = 0
         analyzed_count = 0
         skipped_count = 0
-        all_keywords = set()  # 收集所有提取的关键词
+        all_keywords = set()  # 收集关键词，用于最后给出搜索示例（只需少量，数量有上限）
         analyzer = None  # 延迟初始化
         
-        with tqdm(total=len(image_files), desc="处理进度", unit="张") as pbar:
-            for i, image_file in enumerate(image_files, 1):
-                # 显示相对路径，更清晰显示目录结构
-                # 找到图片文件属于哪个路径，用于计算相对路径
-                relative_path = image_file
-                for path in args.paths:
-                    path_abs = os.path.abspath(path)
-                    if Path(path).is_file():
-                        # 如果是文件，直接使用文件名
-                        if os.path.abspath(image_file) == path_abs:
-                            relative_path = os.path.basename(image_file)
-                            break
-                    else:
-                        # 如果是目录，计算相对路径
-                        if image_file.startswith(path_abs):
-                            relative_path = os.path.relpath(image_file, path)
-                            break
-                
-                # 检查是否已有metadata（除非强制模式）
-                # 在dry-run模式下也跳过检查，让用户预览所有图片的分析结果
-                if not args.force and not args.dry_run:
-                    existing_metadata = metadata_writer.verify_metadata(image_file)
-                    if existing_metadata:
-                        print(f"\n[{i}/{len(image_files)}] ⏭️  跳过（已有metadata）: {relative_path}")
-                        skipped_count += 1
-                        pbar.update(1)
-                        continue
-                
-                # 延迟初始化图片分析器（只在需要分析时初始化）
-                if analyzer is None:
-                    try:
-                        analyzer = ImageAnalyzer()
-                    except ValueError as e:
-                        print(f"❌ {e}")
-                        print("请创建 .env 文件并设置你的 OPENAI_API_KEY")
-                        return 1
-                
-                print(f"\n[{i}/{len(image_files)}] 正在分析: {relative_path}")
-                description = analyzer.analyze_image(image_file, args.screenshot_mode)
-                
-                if description:
-                    analyzed_count += 1
-                    
-                    # 根据模式解析结构化描述并显示要写入的metadata信息
-                    if args.screenshot_mode:
-                        parsed = metadata_writer.parse_description_screenshot(description)
-                        keywords = metadata_writer.extract_keywords_screenshot(description)
-                    else:
-                        parsed = metadata_writer.parse_description(description)
-                        keywords = metadata_writer.extract_keywords(description)
-                    keywords_str = ', '.join(keywords) if keywords else ''
-                    
-                    # 收集关键词用于最终示例
-                    if keywords:
-                        all_keywords.update(keywords[:5])  # 每张图片取前5个关键词
+        # 内容未变的图片直接复用上次的分析结果；未变化的文件也不必重新探测metadata
+        analysis_cache = None
+        metadata_index = None
+        if not args.no_cache:
+            try:
+                analysis_cache = AnalysisCache()
+                metadata_index = MetadataIndex()
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️  无法打开本地缓存，本次不使用缓存: {e}")
+        
+        # 已有metadata的图片（按批检查）；内容相同的图片只分析一次，描述复用到其余副本
+        existing_metadata_map = {}
+        duplicates = {}
+        duplicate_files = set()
+        # --dedup 分组时算出的内容哈希，查询分析缓存时复用
+        file_digests = {}
+        total_count = 0
+        
+        # 分析请求受网络往返时间限制，用线程池并发发送，每完成一张立即处理
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        futures = {}
+        # --group-by-dir：按目录攒够一组再提交；整组的Future用于中断时取消
+        pending_groups = {}
+        group_futures = []
+        # metadata写入放到单独的线程池（每个线程有自己的exiftool进程），不阻塞下一张的分析结果处理
+        write_executor = ThreadPoolExecutor(max_workers=METADATA_WRITE_CONCURRENCY)
+        write_futures = {}
+        # 写入线程的警告和错误先收集起来，全部写入结束后统一输出，避免与进度条交错
+        write_messages = []
+        try:
+            with tqdm(total=0, desc="处理进度", unit="张", mininterval=0.5) as pbar:
+                i = 0
+                for image_batch in image_batches:
+                    # 边扫描边处理时总数随扫描结果增长
+                    total_count += len(image_batch)
+                    pbar.total = total_count
+                    pbar.refresh()
+                    count_text = '' if streaming else f"/{total_count}"
                     
-                    # 根据模式构建搜索优化的短描述
-                    search_description_parts = []
-                    if args.screenshot_mode:
-                        # 截图模式：优先显示文字内容和应用信息
-                        if 'summary' in parsed:
-                            search_description_parts.append(parsed['summary'])
-                        if 'text_content' in parsed:
-                            text_content = parsed['text_content']
-                            if len(text_content) > 100:
-                                text_content = text_content[:100] + "..."
-                            search_description_parts.append(text_content)
-                        if 'app_info' in parsed:
-                            search_description_parts.append(parsed['app_info'])
-                    else:
-                        # 普通模式：原有逻辑
-                        if 'summary' in parsed:
-                            search_description_parts.append(parsed['summary'])
-                        if 'objects' in parsed:
-                            search_description_parts.append(parsed['objects'])
-                        if 'scene' in parsed:
-                            search_description_parts.append(parsed['scene'])
-                    search_description = ' '.join(search_description_parts)
+                    # 每批一次性检查已有metadata，避免逐张启动exiftool
+                    # 在dry-run模式下也跳过检查，让用户预览所有图片的分析结果
+                    if not args.force and not args.dry_run:
+                        known = metadata_index.lookup(image_batch) if metadata_index is not None else {}
+                        existing_metadata_map.update(known)
+                        unknown_files = [f for f in image_batch if f not in known]
+                        if unknown_files:
+                            checked = metadata_writer.verify_metadata_batch(unknown_files)
+                            existing_metadata_map.update(checked)
+                            if metadata_index is not None:
+                                metadata_index.update({f: bool(checked.get(f)) for f in unknown_files})
                     
-                    print(f"  📝 将要写入的metadata字段:")
+                    # 去重时不是流式处理，只有一批（完整列表）
+                    if args.dedup:
+                        duplicates = group_duplicates([f for f in image_batch if not existing_metadata_map.get(f)],
+                                                      file_digests)
+                        if duplicates:
+                            pbar.write(f"♻️  发现 {sum(len(d) for d in duplicates.values())} 张重复图片，将复用描述")
+                        duplicate_files = {f for group in duplicates.values() for f in group}
                     
-                    # 显示实际的metadata字段和值（处理换行，保持缩进对齐）
-                    def format_multiline_field(field_name, content, max_length=100):
-                        """格式化多行字段，保持缩进对齐"""
-                        if not content:
-                            return
+                    for image_file in image_batch:
+                        i += 1
+                        # 显示相对路径，更清晰显示目录结构；每张图片只查询一次，结果随任务一起保存
+                        relative_path, base_dir = path_resolver.resolve(image_file)
                         
-                        lines = content.strip().split('\n')
-                        if len(lines) == 1:
-                            # 单行内容，检查长度
-                            if len(content) > max_length:
-                                content = content[:max_length-3] + "..."
-                            print(f"    {field_name}: {content}")
-                        else:
-                            # 多行内容，保持缩进
-                            print(f"    {field_name}: {lines[0]}")
-                            indent = " " * (len(field_name) + 6)  # 对齐到冒号后面
-                            for line in lines[1:]:
-                                if line.strip():
-                                    print(f"{indent}{line.strip()}")
-                    
-                    if search_description:
-                        search_display = search_description.replace('\n', ' ').strip()
-                        if len(search_display) > 80:
-                            search_display = search_display[:77] + "..."
-                        print(f"    Subject: {search_display}")
-                        print(f"    Caption-Abstract: {search_display}")
+                        # 检查是否已有metadata（除非强制模式）
+                        if existing_metadata_map.get(image_file):
+                            pbar.write(f"\n[{i}{count_text}] ⏭️  跳过（已有metadata）: {relative_path}")
+                            skipped_count += 1
+                            pbar.update(1)
+                            continue
+                        
+                        # 重复图片随代表图片一起处理
+                        if image_file in duplicate_files:
+                            continue
+                        
+                        # 延迟初始化图片分析器（只在需要分析时初始化）
+                        if analyzer is None:
+                            try:
+                                # openai/PIL导入较慢，只在确实需要分析图片时加载
+                                from vision import ImageAnalyzer
+                                analyzer = ImageAnalyzer()
+                            except ValueError as e:
+                                print(f"❌ {e}")
+                                print("请创建 .env 文件并设置你的 OPENAI_API_KEY")
+                                return 1
+                        
+                        pbar.write(f"\n[{i}{count_text}] 正在分析: {relative_path}")
+                        if args.group_by_dir:
+                            group_key = os.path.dirname(image_file)
+                            group = pending_groups.setdefault(group_key, [])
+                            group.append((image_file, relative_path, base_dir))
+                            if len(group) >= VISION_GROUP_SIZE:
+                                group_future, image_futures = submit_group(
+                                    executor, analyzer, analysis_cache, pending_groups.pop(group_key),
+                                    args.screenshot_mode, args.force, file_digests)
+                                group_futures.append(group_future)
+                                futures.update(image_futures)
+                            continue
+                        future = executor.submit(analyze_with_cache, analyzer, analysis_cache,
+                                                 image_file, args.screenshot_mode, args.force, file_digests)
+                        futures[future] = (image_file, relative_path, base_dir)
+                
+                if streaming and total_count:
+                    pbar.write(f"✅ 扫描完成，总共找到 {total_count} 张图片")
+                
+                # 各目录剩余不足一组的图片
+                for group in pending_groups.values():
+                    group_future, image_futures = submit_group(
+                        executor, analyzer, analysis_cache, group, args.screenshot_mode, args.force,
+                        file_digests)
+                    group_futures.append(group_future)
+                    futures.update(image_futures)
+            
+                # 按完成顺序处理分析结果
+                for future in as_completed(futures):
+                    image_file, relative_path, base_dir = futures[future]
+                    description = future.result()
+                    # 代表图片及其内容相同的副本
+                    targets = [(image_file, relative_path, base_dir)]
+                    targets.extend((f, *path_resolver.resolve(f)) for f in duplicates.get(image_file, ()))
                     
                     if description:
-                        format_multiline_field("ImageDescription", description, 120)
-                        format_multiline_field("UserComment", description, 120)
-                    
-                    if keywords_str:
-                        # 限制关键词显示长度
-                        if len(keywords_str) > 80:
-                            keywords_display = keywords_str[:77] + "..."
-                        else:
-                            keywords_display = keywords_str
-                        print(f"    XMP:Description: {keywords_display}")
-                        print(f"    Keywords: {keywords_display}")
-                        print(f"    XMP:Subject: {keywords_display}")
-                    
-                    # 根据模式显示特殊字段
-                    if args.screenshot_mode:
-                        if 'text_content' in parsed and parsed['text_content']:
-                            format_multiline_field("XMP:Title", parsed['text_content'], 100)
-                            print(f"    Creator: {parsed['text_content'][:50]}{'...' if len(parsed['text_content']) > 50 else ''}")
-                        if 'app_info' in parsed and parsed['app_info']:
-                            print(f"    Software: {parsed['app_info']}")
+                        analyzed_count += len(targets)
+                        
+                        # 根据模式解析结构化描述并显示要写入的metadata信息
+                        parsed, keywords = metadata_writer.analyze_description(description, args.screenshot_mode)
+                        
+                        # 收集关键词用于最终示例
+                        if keywords and len(all_keywords) < KEYWORD_EXAMPLE_BUDGET:
+                            all_keywords.update(keywords[:5])  # 每张图片取前5个关键词
+                        
+                        # 每张图片的输出先写入缓冲区，最后通过tqdm一次性输出，避免与进度条争抢终端
+                        out = io.StringIO()
+                        # 预览模式下总是显示字段预览，普通运行只在 --verbose 时显示
+                        if args.verbose or args.dry_run:
+                            out.write(format_metadata_preview(description, parsed, keywords, args.screenshot_mode))
+                        
+                        out.write(f"  ✅ 分析完成: {relative_path} (共{len(keywords)}个关键词)\n")
+                        for _, duplicate_path, _ in targets[1:]:
+                            out.write(f"  ♻️  内容相同，复用描述: {duplicate_path}\n")
+                        
+                        # 预览模式：只显示，不写入
+                        if args.dry_run:
+                            out.write("  📋 预览模式：跳过metadata写入")
+                            pbar.write(out.getvalue())
+                            pbar.update(len(targets))
+                            continue
+                        
+                        # 立即写入metadata
+                        out.write("  💾 正在写入metadata...")
+                        pbar.write(out.getvalue())
+                        for target_file, _, target_base_dir in targets:
+                            write_future = write_executor.submit(
+                                metadata_writer.write_metadata, target_file, description,
+                                args.screenshot_mode, target_base_dir, write_messages)
+                            write_futures[write_future] = target_file
                     else:
-                        if 'text' in parsed and parsed['text'] and parsed['text'] != '无':
-                            format_multiline_field("XMP:Title", parsed['text'], 80)
-                    
-                    print(f"  ✅ 分析完成 (共{len(keywords)}个关键词)")
+                        pbar.write(f"  ❌ 分析失败: {relative_path}")
                     
-                    # 预览模式：只显示，不写入
-                    if args.dry_run:
-                        print(f"  📋 预览模式：跳过metadata写入")
-                        pbar.update(1)
-                        continue
-                    
-                    # 立即写入metadata
-                    print(f"  💾 正在写入metadata...")
-                    # 临时设置当前处理路径，用于显示相对路径
-                    current_base_path = None
-                    for path in args.paths:
-                        path_abs = os.path.abspath(path)
-                        if Path(path).is_file():
-                            if os.path.abspath(image_file) == path_abs:
-                                current_base_path = os.path.dirname(path)
-                                break
-                        else:
-                            if image_file.startswith(path_abs):
-                                current_base_path = path
-                                break
-                    metadata_writer._current_base_dir = current_base_path
-                    if metadata_writer.write_metadata(image_file, description, args.screenshot_mode):
-                        success_count += 1
-                else:
-                    print(f"  ❌ 分析失败")
+                    pbar.update(len(targets))
                 
-                pbar.update(1)
+                # 等待剩余的metadata写入完成
+                for write_future in as_completed(write_futures):
+                    if write_future.result():
+                        success_count += 1
+                        if metadata_index is not None:
+                            metadata_index.update({write_futures[write_future]: True})
+                for message in write_messages:
+                    pbar.write(message)
+        finally:
+            # 中断时取消尚未开始的分析请求和写入；已开始的写入会完成，避免文件处于中间状态
+            # （shutdown 的 cancel_futures 参数要求Python 3.9+，这里逐个取消以兼容3.8）
+            for future in (*futures, *group_futures, *write_futures):
+                future.cancel()
+            executor.shutdown()
+            write_executor.shutdown()
+            metadata_writer.close()
+            if analysis_cache is not None:
+                analysis_cache.close()
+            if metadata_index is not None:
+                metadata_index.close()
+        
+        if total_count == 0:
+            print("❌ 未找到支持的图片文件")
+            print(f"支持的格式: {_SUPPORTED_FORMATS_TEXT}")
+            return 1
         
         if analyzed_count == 0 and skipped_count == 0:
             print("❌ 没有成功处理的图片")
@@ -352,23 +828,18 @@ def main():
         
         # 触发Spotlight重新索引
         print("\n🔄 触发Spotlight重新索引...")
-        indexed_dirs = set()
-        for path in args.paths:
-            if Path(path).is_file():
-                # 对文件所在目录进行重新索引
-                dir_path = os.path.dirname(path)
-                if dir_path not in indexed_dirs:
-                    metadata_writer.trigger_spotlight_reindex(dir_path)
-                    indexed_dirs.add(dir_path)
-            else:
-                # 对目录进行重新索引
-                if path not in indexed_dirs:
-                    metadata_writer.trigger_spotlight_reindex(path)
-                    indexed_dirs.add(path)
+        # 单个文件对其所在目录重新索引；按输入顺序去重
+        indexed_dirs = list(dict.fromkeys(
+            (os.path.dirname(path) or '.') if path_resolver.is_file(path) else path
+            for path in args.paths
+        ))
+        # mdimport 在后台运行，这里只是逐个启动
+        for indexed_dir in indexed_dirs:
+            metadata_writer.trigger_spotlight_reindex(indexed_dir)
         
         # 总结
         print(f"\n📊 处理完成!")
-        print(f"   总计: {len(image_files)} 张图片")
+        print(f"   总计: {total_count} 张图片")
         if skipped_count > 0:
             print(f"   跳过（已有metadata）: {skipped_count} 张")
         print(f"   识别成功: {analyzed_count} 张")
@@ -392,6 +863,8 @@ def main():
     except Exception as e:
         print(f"\n❌ 发生错误: {str(e)}")
         return 1
+    finally:
+        stop_log_listener(log_listener)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,203 @@
+import functools
+import heapq
+import json
 import subprocess
 import os
+import re
+import select
 import shutil
 import stat
-from typing import Optional, Dict, List
-from config import METADATA_FIELDS
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, List, NamedTuple, Tuple
+from config import METADATA_FIELDS, METADATA_WRITE_CONCURRENCY
+
+# orjson可选：批量验证时exiftool一次输出几百个文件的JSON，解析更快
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 检查已有metadata时读取的字段
+VERIFY_TAGS = (
+    '-ImageDescription',
+    '-UserComment',
+    '-Subject',
+    '-Keywords',
+    '-XMP:Description',
+    '-XMP:Subject',
+)
+
+# 每次写入都相同的exiftool选项
+WRITE_OPTIONS = (
+    '-charset', 'utf8',     # 支持中文
+    '-codedcharacterset=utf8',  # 强制UTF-8编码
+    '-preserve',  # 保留文件时间戳
+    '-P',  # 保持原始文件修改时间
+    '-quiet',  # 减少输出
+    # 注意：不使用 -overwrite_original，让exiftool创建备份
+)
+
+# 结构化描述中各行的前缀与解析结果字段名的对应关系
+_NORMAL_FIELDS = {
+    '主要内容': 'summary',
+    '对象': 'objects',
+    '场景': 'scene',
+    '颜色': 'colors',
+    '风格': 'style',
+    '文字': 'text',
+    '情感': 'emotion',
+}
+_SCREENSHOT_FIELDS = {
+    '主要内容': 'summary',
+    '文字内容': 'text_content',
+    '应用信息': 'app_info',
+    '界面元素': 'ui_elements',
+    '功能区域': 'function_areas',
+    '主题色彩': 'colors',
+}
+
+
+def _field_line_re(fields: Dict[str, str]) -> re.Pattern:
+    """匹配以 “前缀：” 开头的行，一次扫描整段描述即可取出所有字段"""
+    return re.compile(r'^\s*(' + '|'.join(map(re.escape, fields)) + r')：(.*)$', re.MULTILINE)
+
+
+_NORMAL_FIELD_RE = _field_line_re(_NORMAL_FIELDS)
+_SCREENSHOT_FIELD_RE = _field_line_re(_SCREENSHOT_FIELDS)
+
+# 关键词分词：以空白和中文标点为界（保留英文的 . 和 : 以免拆开 10:30、3.14 之类的内容）
+_KEYWORD_TOKEN_RE = re.compile(r'[^\s，。、！？：；（）【】《》「」“”‘’…]+')
+# 短于该长度的关键词做字符串驻留
+_INTERN_MAX_LEN = 16
+
+
+class _KeywordRules(NamedTuple):
+    """关键词提取规则"""
+    field_re: re.Pattern
+    min_len: Dict[str, int]  # 个别字段的最短词长
+    default_min_len: int  # 其余字段的最短词长
+    limit: int  # 最多保留的关键词数
+    fallback_limit: int  # 解析出错时备用方案保留的关键词数
+
+
+# 普通模式过滤掉单字；截图模式不过滤短词，因为UI文字可能包含重要的短词汇（主要内容除外），且可以有更多关键词
+_NORMAL_KEYWORD_RULES = _KeywordRules(_NORMAL_FIELD_RE, {}, 2, 15, 10)
+_SCREENSHOT_KEYWORD_RULES = _KeywordRules(_SCREENSHOT_FIELD_RE, {'主要内容': 2}, 1, 25, 20)
+
+
+@functools.lru_cache(maxsize=None)
+def _dir_prefix(base_dir: str) -> str:
+    """基准目录的绝对路径（以分隔符结尾），同一目录下的图片只需一次前缀比较"""
+    return os.path.join(os.path.abspath(base_dir), '')
+
+
+def _stat_access(path: str, st: os.stat_result) -> Tuple[bool, bool]:
+    """根据已有的stat结果判断文件是否可读、可写
+    
+    文件属于当前用户且权限位已经不允许读或写时直接返回，省去 os.access 系统调用；
+    权限位允许时仍交给 os.access 确认（ACL、只读挂载等限制不体现在权限位上），
+    其他情况（root、组权限）同样交给 os.access。
+    """
+    if hasattr(os, 'geteuid') and st.st_uid == os.geteuid() != 0:
+        readable, writable = bool(st.st_mode & stat.S_IRUSR), bool(st.st_mode & stat.S_IWUSR)
+        if not (readable and writable):
+            return readable, writable
+    return os.access(path, os.R_OK), os.access(path, os.W_OK)
+
+
+class ExifToolProcess:
+    """常驻的exiftool进程（-stay_open模式）
+    
+    exiftool每次启动都要加载Perl解释器和模块（约200ms），常驻进程通过stdin接收参数、
+    以 -execute 分隔每条命令，只需启动一次。
+    """
+    
+    def __init__(self):
+        self._process = None
+        self._counter = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _format_arg(arg: str) -> str:
+        """将参数转换为argfile中的一行，包含换行等字符或以#开头（会被当作注释）的参数使用C风格转义"""
+        if arg.startswith('#') or any(c in arg for c in '\n\r\t\\'):
+            escaped = (arg.replace('\\', '\\\\').replace('\n', '\\n')
+                       .replace('\r', '\\r').replace('\t', '\\t'))
+            return '#[CSTR]' + escaped
+        return arg
+    
+    def _start(self):
+        self._process = subprocess.Popen(
+            ['exiftool', '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+    
+    def _read_until(self, stream, sentinel: bytes, deadline: float, timeout: float) -> bytes:
+        """从管道读取输出直到出现sentinel行"""
+        fd = stream.fileno()
+        output = b''
+        while not output.rstrip().endswith(sentinel):
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([fd], [], [], max(remaining, 0))
+            if not ready:
+                raise subprocess.TimeoutExpired('exiftool', timeout)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise BrokenPipeError("exiftool进程意外退出")
+            output += chunk
+        return output.rstrip()[:-len(sentinel)]
+    
+    def execute(self, args: List[str], timeout: float = 30) -> Tuple[str, str]:
+        """执行一条exiftool命令，返回 (stdout, stderr)"""
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+            
+            self._counter += 1
+            sentinel = f'{{ready{self._counter}}}'
+            lines = [self._format_arg(arg) for arg in args]
+            lines += ['-echo4', sentinel, f'-execute{self._counter}']
+            
+            try:
+                self._process.stdin.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+                self._process.stdin.flush()
+                deadline = time.monotonic() + timeout
+                stdout = self._read_until(self._process.stdout, sentinel.encode(), deadline, timeout)
+                stderr = self._read_until(self._process.stderr, sentinel.encode(), deadline, timeout)
+            except BaseException:
+                # 输出状态未知，丢弃这个进程，下次调用时重新启动
+                self._kill()
+                raise
+            
+            return stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+    
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+    
+    def close(self):
+        """通知exiftool退出常驻模式"""
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                if self._process.poll() is None:
+                    self._process.stdin.write(b'-stay_open\nFalse\n')
+                    self._process.stdin.flush()
+                    self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+            finally:
+                self._process = None
 
 
 class MetadataWriter:
@@ -12,260 +206,179 @@ class MetadataWriter:
         if not shutil.which('exiftool'):
             raise RuntimeError("exiftool 未安装。请运行: brew install exiftool")
         self._current_base_dir = None  # 用于显示相对路径
+        # 每个线程使用自己的常驻exiftool进程，并发写入时互不阻塞
+        self._exiftool_local = threading.local()
+        self._exiftool_processes = []
+        self._exiftool_lock = threading.Lock()
+        # 预览和写入会对同一条描述各解析一次，内容相同的图片也共用描述，缓存解析结果
+        self._analyze_description_cached = functools.lru_cache(maxsize=1024)(self._analyze_description)
+    
+    @property
+    def _exiftool(self) -> ExifToolProcess:
+        """当前线程的常驻exiftool进程"""
+        process = getattr(self._exiftool_local, 'process', None)
+        if process is None:
+            process = ExifToolProcess()  # 首次写入时才启动
+            self._exiftool_local.process = process
+            with self._exiftool_lock:
+                self._exiftool_processes.append(process)
+        return process
+    
+    def close(self):
+        """关闭所有线程的常驻exiftool进程"""
+        with self._exiftool_lock:
+            for process in self._exiftool_processes:
+                process.close()
+    
+    def __del__(self):
+        for process in getattr(self, '_exiftool_processes', ()):
+            process.close()
+    
+    def _run_exiftool(self, args: List[str], timeout: float = 30) -> Tuple[bool, str]:
+        """通过常驻进程执行exiftool写入命令，返回 (是否成功, 错误输出)
+        
+        常驻进程无法启动或通信失败时，退回到单次调用exiftool。
+        """
+        try:
+            _, stderr = self._exiftool.execute(args, timeout)
+            # -quiet 模式下只有出错时才会输出 Error 行
+            success = not any(line.startswith('Error') for line in stderr.splitlines())
+            return success, stderr
+        except (OSError, ValueError):
+            pass
+        
+        # 写入命令带 -quiet，stdout 没有需要的内容；stderr 只在失败时才解码
+        result = subprocess.run(
+            ['exiftool', *args],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=timeout
+        )
+        if result.returncode == 0:
+            return True, ''
+        return False, result.stderr.decode('utf-8', 'replace')
     
-    def _get_display_path(self, image_path: str) -> str:
+    def _get_display_path(self, image_path: str, base_dir: Optional[str] = None) -> str:
         """获取用于显示的路径（相对路径或文件名）"""
-        if self._current_base_dir and os.path.commonpath([image_path, self._current_base_dir]):
-            try:
-                return os.path.relpath(image_path, self._current_base_dir)
-            except ValueError:
-                pass
+        if base_dir is None:
+            base_dir = self._current_base_dir
+        if base_dir:
+            prefix = _dir_prefix(base_dir)
+            if not os.path.isabs(image_path):
+                image_path = os.path.abspath(image_path)
+            if image_path.startswith(prefix):
+                return image_path[len(prefix):]
         return os.path.basename(image_path)
     
     def extract_keywords_screenshot(self, description: str) -> List[str]:
         """从截图模式的结构化描述中提取关键词（专门优化文字搜索）"""
-        keywords = set()
-        
-        try:
-            lines = description.strip().split('\n')
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # 截图模式的特殊字段处理
-                if line.startswith('文字内容：'):
-                    # 这是最重要的部分，包含所有可见文字
-                    text_content = line[5:].strip()
-                    if text_content:
-                        # 按空格分词，保留所有文字
-                        words = text_content.split()
-                        for word in words:
-                            word = word.strip()
-                            if len(word) >= 1:  # 截图模式保留更多短词
-                                keywords.add(word)
-                
-                elif line.startswith('应用信息：'):
-                    app_info = line[5:].strip()
-                    if app_info:
-                        keywords.update(word.strip() for word in app_info.split())
-                
-                elif line.startswith('界面元素：'):
-                    ui_elements = line[5:].strip()
-                    if ui_elements:
-                        keywords.update(elem.strip() for elem in ui_elements.split())
-                
-                elif line.startswith('功能区域：'):
-                    areas = line[5:].strip()
-                    if areas:
-                        keywords.update(area.strip() for area in areas.split())
-                
-                elif line.startswith('主要内容：'):
-                    content = line[5:].strip()
-                    if content:
-                        # 从主要内容中提取关键词
-                        content_words = content.replace('，', ' ').replace('。', ' ').split()
-                        keywords.update(word.strip() for word in content_words if len(word.strip()) > 1)
-                
-                elif line.startswith('主题色彩：'):
-                    colors = line[5:].strip()
-                    if colors:
-                        keywords.update(color.strip() for color in colors.split())
-            
-            # 截图模式不过滤短词，因为UI文字可能包含重要的短词汇
-            filtered_keywords = [
-                kw for kw in keywords 
-                if len(kw) >= 1 and not all(c in '，。、！？：；' for c in kw)
-            ]
-            
-            # 限制关键词数量，优先保留较长的关键词
-            sorted_keywords = sorted(filtered_keywords, key=len, reverse=True)
-            return sorted_keywords[:25]  # 截图模式可以有更多关键词
-            
-        except Exception as e:
-            print(f"截图关键词提取出错，使用备用方案: {e}")
-            # 备用方案：简单分词
-            words = description.replace('，', ' ').replace('。', ' ').replace('：', ' ').split()
-            return [word.strip() for word in words if len(word.strip()) >= 1][:20]
+        return self._extract_keywords(description, _SCREENSHOT_KEYWORD_RULES)
 
     def extract_keywords(self, description: str) -> List[str]:
         """从结构化描述中提取关键词"""
+        return self._extract_keywords(description, _NORMAL_KEYWORD_RULES)
+    
+    def _extract_keywords(self, description: str, rules: _KeywordRules) -> List[str]:
+        """按模式的规则表提取关键词：逐字段分词、按最短词长过滤，保留最长的若干个"""
         keywords = set()  # 使用set避免重复
         
         try:
-            # 解析结构化描述的各个部分
-            lines = description.strip().split('\n')
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
+            # 一次正则扫描取出各个分类的内容
+            for match in rules.field_re.finditer(description):
+                value = match.group(2).strip()
+                # 空字段或“无”表示该分类没有内容
+                if not value or value == '无':
                     continue
-                    
-                # 提取各个分类的内容
-                if line.startswith('对象：'):
-                    objects = line[3:].strip()
-                    if objects:
-                        keywords.update(obj.strip() for obj in objects.split())
-                        
-                elif line.startswith('场景：'):
-                    scene = line[3:].strip()
-                    if scene:
-                        keywords.update(word.strip() for word in scene.split())
-                        
-                elif line.startswith('颜色：'):
-                    colors = line[3:].strip()
-                    if colors:
-                        keywords.update(color.strip() for color in colors.split())
-                        
-                elif line.startswith('风格：'):
-                    style = line[3:].strip()
-                    if style:
-                        keywords.update(s.strip() for s in style.split())
-                        
-                elif line.startswith('文字：'):
-                    text_content = line[3:].strip()
-                    if text_content and text_content != '无':
-                        # 对文字内容进行简单分词
-                        words = text_content.replace('，', ' ').replace('。', ' ').split()
-                        keywords.update(word.strip() for word in words if len(word.strip()) > 1)
-                        
-                elif line.startswith('情感：'):
-                    emotions = line[3:].strip()
-                    if emotions:
-                        keywords.update(emotion.strip() for emotion in emotions.split())
-                        
-                elif line.startswith('主要内容：'):
-                    content = line[5:].strip()
-                    if content:
-                        # 从主要内容中提取关键词
-                        content_words = content.replace('，', ' ').replace('。', ' ').split()
-                        keywords.update(word.strip() for word in content_words if len(word.strip()) > 1)
-            
-            # 过滤掉过短的词和标点符号
-            filtered_keywords = [
-                kw for kw in keywords 
-                if len(kw) >= 2 and not all(c in '，。、！？：；' for c in kw)
-            ]
+                
+                min_len = rules.min_len.get(match.group(1), rules.default_min_len)
+                for word in _KEYWORD_TOKEN_RE.findall(value):
+                    if len(word) >= min_len:
+                        # 颜色、界面元素等短词在整批图片中反复出现，驻留后共用同一个对象
+                        keywords.add(sys.intern(word) if len(word) < _INTERN_MAX_LEN else word)
             
             # 限制关键词数量，优先保留较长的关键词（通常更具描述性）
-            sorted_keywords = sorted(filtered_keywords, key=len, reverse=True)
-            return sorted_keywords[:15]  # 增加到15个关键词
+            return heapq.nlargest(rules.limit, keywords, key=len)
             
         except Exception as e:
             print(f"关键词提取出错，使用备用方案: {e}")
             # 备用方案：简单分词
-            words = description.replace('，', ' ').replace('。', ' ').replace('：', ' ').split()
-            return [word.strip() for word in words if len(word.strip()) >= 2][:10]
+            words = _KEYWORD_TOKEN_RE.findall(description)
+            return [word for word in words if len(word) >= rules.default_min_len][:rules.fallback_limit]
     
     def parse_description_screenshot(self, description: str) -> Dict[str, str]:
         """解析截图模式的结构化描述，提取各个组件"""
-        parsed = {}
-        lines = description.strip().split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('主要内容：'):
-                parsed['summary'] = line[5:].strip()
-            elif line.startswith('文字内容：'):
-                parsed['text_content'] = line[5:].strip()
-            elif line.startswith('应用信息：'):
-                parsed['app_info'] = line[5:].strip()
-            elif line.startswith('界面元素：'):
-                parsed['ui_elements'] = line[5:].strip()
-            elif line.startswith('功能区域：'):
-                parsed['function_areas'] = line[5:].strip()
-            elif line.startswith('主题色彩：'):
-                parsed['colors'] = line[5:].strip()
-        
-        return parsed
+        return {
+            _SCREENSHOT_FIELDS[match.group(1)]: match.group(2).strip()
+            for match in _SCREENSHOT_FIELD_RE.finditer(description)
+        }
 
     def parse_description(self, description: str) -> Dict[str, str]:
         """解析结构化描述，提取各个组件"""
-        parsed = {}
-        lines = description.strip().split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('主要内容：'):
-                parsed['summary'] = line[5:].strip()
-            elif line.startswith('对象：'):
-                parsed['objects'] = line[3:].strip()
-            elif line.startswith('场景：'):
-                parsed['scene'] = line[3:].strip()
-            elif line.startswith('颜色：'):
-                parsed['colors'] = line[3:].strip()
-            elif line.startswith('风格：'):
-                parsed['style'] = line[3:].strip()
-            elif line.startswith('文字：'):
-                parsed['text'] = line[3:].strip()
-            elif line.startswith('情感：'):
-                parsed['emotion'] = line[3:].strip()
+        return {
+            _NORMAL_FIELDS[match.group(1)]: match.group(2).strip()
+            for match in _NORMAL_FIELD_RE.finditer(description)
+        }
+    
+    def analyze_description(self, description: str, screenshot_mode: bool = False) -> Tuple[Dict[str, str], List[str]]:
+        """根据模式解析结构化描述并提取关键词，返回 (parsed, keywords)
         
-        return parsed
-
-    def write_metadata(self, image_path: str, description: str, screenshot_mode: bool = False) -> bool:
-        """写入图片metadata并保留原始文件时间"""
-        import tempfile
-        import shutil
+        相同的 (描述, 模式) 只解析一次；返回的是副本，调用方可以随意修改。
+        """
+        parsed, keywords = self._analyze_description_cached(description, screenshot_mode)
+        return dict(parsed), list(keywords)
+    
+    def _analyze_description(self, description: str, screenshot_mode: bool) -> Tuple[Dict[str, str], List[str]]:
+        if screenshot_mode:
+            return self.parse_description_screenshot(description), self.extract_keywords_screenshot(description)
+        return self.parse_description(description), self.extract_keywords(description)
+    
+    def write_metadata(self, image_path: str, description: str, screenshot_mode: bool = False,
+                       base_dir: Optional[str] = None, messages: Optional[List[str]] = None) -> bool:
+        """写入图片metadata并保留原始文件时间
         
+        Args:
+            base_dir: 显示相对路径时使用的基准目录，不传时使用 _current_base_dir；
+                多线程并发写入时应通过参数传入
+            messages: 传入列表时不直接打印，把警告和错误追加到列表中（省略成功消息），
+                由调用方在写入结束后统一输出，避免并发写入的输出与进度条交错
+        """
         try:
-            # 1. 文件安全检查
-            display_path = self._get_display_path(image_path)
-            
-            if not os.path.exists(image_path):
-                print(f"  ⚠️  文件不存在，跳过: {display_path}")
+            # 1. 文件安全检查：一次stat同时完成存在性、权限和大小检查
+            # （显示路径只在出错时才需要，在各分支中计算）
+            try:
+                file_stat = os.stat(image_path)
+            except FileNotFoundError:
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ⚠️  文件不存在，跳过: {display_path}")
                 return False
-            
-            if not os.access(image_path, os.R_OK):
-                print(f"  ⚠️  文件无读取权限，跳过: {display_path}")
+            except OSError as e:
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ⚠️  文件状态异常，跳过: {display_path} - {e}")
                 return False
             
-            if not os.access(image_path, os.W_OK):
-                print(f"  ⚠️  文件无写入权限，跳过: {display_path}")
+            readable, writable = _stat_access(image_path, file_stat)
+            if not readable:
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ⚠️  文件无读取权限，跳过: {display_path}")
                 return False
             
-            # 2. 文件完整性检查
-            try:
-                file_stat = os.stat(image_path)
-                if file_stat.st_size == 0:
-                    print(f"  ⚠️  文件为空，跳过: {display_path}")
-                    return False
-            except OSError as e:
-                print(f"  ⚠️  文件状态异常，跳过: {display_path} - {e}")
+            if not writable:
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ⚠️  文件无写入权限，跳过: {display_path}")
                 return False
             
-            # 3. 创建备份文件（在临时目录）
-            backup_fd, backup_path = tempfile.mkstemp(suffix='.backup', prefix='img_metadata_')
-            try:
-                with os.fdopen(backup_fd, 'wb') as backup_file:
-                    with open(image_path, 'rb') as original_file:
-                        shutil.copyfileobj(original_file, backup_file)
-                print(f"  💾 已创建临时备份: {os.path.basename(backup_path)}")
-            except Exception as e:
-                os.close(backup_fd)
-                if os.path.exists(backup_path):
-                    os.unlink(backup_path)
-                print(f"  ❌ 备份创建失败，跳过处理: {e}")
+            # 2. 文件完整性检查
+            if file_stat.st_size == 0:
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ⚠️  文件为空，跳过: {display_path}")
                 return False
             
-            # 保存原始文件的时间信息
-            original_atime = file_stat.st_atime  # 访问时间
-            original_mtime = file_stat.st_mtime  # 修改时间
+            # 3. 保存原始文件的时间信息
+            original_times = (file_stat.st_atime_ns, file_stat.st_mtime_ns)  # 访问时间、修改时间
             
-            # 根据模式选择解析方法
-            if screenshot_mode:
-                parsed = self.parse_description_screenshot(description)
-                keywords = self.extract_keywords_screenshot(description)
-            else:
-                parsed = self.parse_description(description)
-                keywords = self.extract_keywords(description)
+            # 根据模式解析描述（预览时已解析过的描述直接命中缓存）
+            parsed, keywords = self.analyze_description(description, screenshot_mode)
             keywords_str = ', '.join(keywords) if keywords else ''
             
             # 根据模式创建搜索优化的短描述
@@ -294,15 +407,7 @@ class MetadataWriter:
             search_description = ' '.join(search_description_parts)
             
             # 4. 构建安全的exiftool命令
-            cmd = [
-                'exiftool',
-                '-charset', 'utf8',     # 支持中文
-                '-codedcharacterset=utf8',  # 强制UTF-8编码
-                '-preserve',  # 保留文件时间戳
-                '-P',  # 保持原始文件修改时间
-                '-quiet',  # 减少输出
-                # 注意：不使用 -overwrite_original，让exiftool创建备份
-            ]
+            cmd = list(WRITE_OPTIONS)
             
             # 分层写入不同信息：
             # 1. Subject和Caption-Abstract：用搜索优化的短描述
@@ -319,14 +424,10 @@ class MetadataWriter:
             ])
             
             # 3. XMP:Description：用搜索关键词（Spotlight优先搜索）
-            if keywords_str:
-                cmd.extend([
-                    f'-XMP:Description={keywords_str}',
-                ])
-            
             # 4. Keywords和XMP:Subject：用提取的关键词
             if keywords_str:
                 cmd.extend([
+                    f'-XMP:Description={keywords_str}',
                     f'-Keywords={keywords_str}',
                     f'-XMP:Subject={keywords_str}',
                 ])
@@ -341,117 +442,106 @@ class MetadataWriter:
                     ])
                 # 应用信息存储到Software字段
                 if 'app_info' in parsed and parsed['app_info']:
-                    cmd.extend([
-                        f'-Software={parsed["app_info"]}',
-                    ])
+                    cmd.append(f'-Software={parsed["app_info"]}')
             else:
                 # 普通模式：原有逻辑
                 if 'text' in parsed and parsed['text'] and parsed['text'] != '无':
-                    cmd.extend([
-                        f'-XMP:Title={parsed["text"]}',
-                    ])
+                    cmd.append(f'-XMP:Title={parsed["text"]}')
             
             cmd.append(image_path)
             
-            # 5. 执行exiftool命令
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                encoding='utf-8',
-                timeout=30  # 30秒超时
-            )
+            # 5. 执行exiftool命令（30秒超时）
+            success, stderr = self._run_exiftool(cmd, timeout=30)
             
-            if result.returncode == 0:
-                # 6. 验证文件完整性
+            if success:
+                # 6. 验证文件完整性；exiftool写入时会把原文件改名为 <文件名>_original，用作恢复来源
+                exif_backup = image_path + '_original'
                 try:
                     new_stat = os.stat(image_path)
                     if new_stat.st_size == 0:
                         # 文件被破坏，从备份恢复
-                        print(f"  ⚠️  检测到文件损坏，正在从备份恢复...")
-                        shutil.copy2(backup_path, image_path)
-                        os.unlink(backup_path)
+                        display_path = self._get_display_path(image_path, base_dir)
+                        if not os.path.exists(exif_backup):
+                            self._report(messages, f"  ❌ 检测到文件损坏，且没有可用的备份: {display_path}")
+                            return False
+                        self._report(messages, f"  ⚠️  检测到文件损坏，正在从备份恢复: {display_path}")
+                        os.replace(exif_backup, image_path)
                         return False
                     
                     # 文件正常，清理exiftool创建的备份文件
-                    exif_backup = image_path + '_original'
                     if os.path.exists(exif_backup):
                         os.unlink(exif_backup)
                     
-                    # 恢复原始文件时间
-                    os.utime(image_path, (original_atime, original_mtime))
-                    print(f"  ✅ Metadata写入成功 ({len(keywords)}个关键词)")
-                    
-                    # 清理临时备份
-                    os.unlink(backup_path)
+                    # 恢复原始文件时间（-P 通常已经保留，只有不一致时才需要再设置）
+                    if (new_stat.st_atime_ns, new_stat.st_mtime_ns) != original_times:
+                        os.utime(image_path, ns=original_times)
+                    if messages is None:
+                        print(f"  ✅ Metadata写入成功 ({len(keywords)}个关键词)")
                     return True
                     
                 except Exception as e:
-                    print(f"  ⚠️  文件验证失败，从备份恢复: {e}")
-                    shutil.copy2(backup_path, image_path)
-                    os.unlink(backup_path)
+                    display_path = self._get_display_path(image_path, base_dir)
+                    if os.path.exists(exif_backup):
+                        self._report(messages, f"  ⚠️  文件验证失败，从备份恢复: {display_path} - {e}")
+                        os.replace(exif_backup, image_path)
+                    else:
+                        # 备份已清理（如恢复文件时间时出错）或从未创建，没有可恢复的内容，只报告原始错误
+                        self._report(messages, f"  ❌ 写入后处理失败（没有可用的备份，未恢复）: {display_path} - "
+                                               f"{type(e).__name__}: {e}")
                     return False
             else:
-                print(f"  ❌ Metadata写入失败: {result.stderr}")
-                # 清理临时备份
-                os.unlink(backup_path)
+                # 写入失败时exiftool不会改动原文件
+                display_path = self._get_display_path(image_path, base_dir)
+                self._report(messages, f"  ❌ Metadata写入失败: {display_path} - {stderr}")
                 return False
                 
         except subprocess.TimeoutExpired:
-            display_path = self._get_display_path(image_path)
-            print(f"  ⚠️  操作超时，跳过: {display_path}")
-            # 清理备份
-            if 'backup_path' in locals() and os.path.exists(backup_path):
-                os.unlink(backup_path)
+            display_path = self._get_display_path(image_path, base_dir)
+            self._report(messages, f"  ⚠️  操作超时，跳过: {display_path}")
             return False
         except Exception as e:
-            display_path = self._get_display_path(image_path)
-            print(f"  ❌ 意外错误，跳过: {display_path} - {str(e)}")
-            # 清理备份
-            if 'backup_path' in locals() and os.path.exists(backup_path):
-                os.unlink(backup_path)
+            display_path = self._get_display_path(image_path, base_dir)
+            self._report(messages, f"  ❌ 意外错误，跳过: {display_path} - {str(e)}")
             return False
     
+    @staticmethod
+    def _report(messages: Optional[List[str]], message: str):
+        """输出一条写入消息，或追加到调用方收集消息的列表中"""
+        if messages is None:
+            print(message)
+        else:
+            messages.append(message)
+    
+    def _filter_metadata(self, data: Dict[str, str]) -> Dict[str, str]:
+        """过滤exiftool返回的单个文件结果，只保留有实际描述内容的metadata"""
+        metadata = {k: v for k, v in data.items() if v and k != 'SourceFile'}
+        
+        # 检查是否只有默认的Screenshot标记，如果是则认为没有有效metadata
+        if metadata:
+            # 如果只有UserComment且值为"Screenshot"，认为没有有效metadata
+            if len(metadata) == 1 and metadata.get('UserComment') == 'Screenshot':
+                return {}
+            # 检查是否有实际的描述内容
+            has_description = any(
+                field in metadata and len(str(metadata[field]).strip()) > 10
+                for field in ['ImageDescription', 'XMP:Description', 'Subject', 'XMP:Subject']
+            )
+            if has_description:
+                return metadata
+        
+        return {}
+    
     def verify_metadata(self, image_path: str) -> Dict[str, str]:
         """验证metadata是否写入成功"""
         try:
-            cmd = [
-                'exiftool',
-                '-ImageDescription',
-                '-UserComment',
-                '-Subject',
-                '-Keywords',
-                '-XMP:Description',
-                '-XMP:Subject', 
-                '-j',  # JSON输出
-                image_path
-            ]
+            cmd = ['exiftool', *VERIFY_TAGS, '-j', image_path]
             
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                encoding='utf-8'
-            )
+            result = subprocess.run(cmd, capture_output=True)
             
             if result.returncode == 0:
-                import json
-                data = json.loads(result.stdout)
+                data = _json_loads(result.stdout)
                 if data:
-                    metadata = {k: v for k, v in data[0].items() if v and k != 'SourceFile'}
-                    
-                    # 检查是否只有默认的Screenshot标记，如果是则认为没有有效metadata
-                    if metadata:
-                        # 如果只有UserComment且值为"Screenshot"，认为没有有效metadata
-                        if len(metadata) == 1 and metadata.get('UserComment') == 'Screenshot':
-                            return {}
-                        # 检查是否有实际的描述内容
-                        has_description = any(
-                            field in metadata and len(str(metadata[field]).strip()) > 10
-                            for field in ['ImageDescription', 'XMP:Description', 'Subject', 'XMP:Subject']
-                        )
-                        if has_description:
-                            return metadata
+                    return self._filter_metadata(data[0])
                     
             return {}
             
@@ -459,27 +549,73 @@ class MetadataWriter:
             print(f"验证metadata时出错: {str(e)}")
             return {}
     
-    def batch_write_metadata(self, descriptions: Dict[str, str], screenshot_mode: bool = False) -> Dict[str, bool]:
+    def verify_metadata_batch(self, image_paths: List[str], chunk_size: int = 500) -> Dict[str, Dict[str, str]]:
+        """批量验证metadata，每chunk_size个文件只启动一次exiftool
+        
+        Args:
+            image_paths: 图片路径列表
+            chunk_size: 每次exiftool调用处理的文件数（避免超出命令行长度限制）
+        
+        Returns:
+            图片路径到有效metadata的字典，没有有效metadata的图片对应空字典
+        """
+        results = {}
+        
+        for start in range(0, len(image_paths), chunk_size):
+            chunk = image_paths[start:start + chunk_size]
+            try:
+                # 直接解析UTF-8字节，不先解码成str
+                result = subprocess.run(['exiftool', *VERIFY_TAGS, '-j', *chunk], capture_output=True)
+                # 部分文件读取失败时exiftool返回非0，但其余文件的结果仍然有效
+                if result.stdout.strip():
+                    for data in _json_loads(result.stdout):
+                        results[data.get('SourceFile')] = self._filter_metadata(data)
+            except Exception as e:
+                print(f"批量验证metadata时出错: {str(e)}")
+        
+        return results
+    
+    def batch_write_metadata(self, descriptions: Dict[str, str], screenshot_mode: bool = False,
+                             max_workers: int = METADATA_WRITE_CONCURRENCY) -> Dict[str, bool]:
         """批量写入metadata
         
+        多个线程并发写入，每个线程复用自己的常驻exiftool进程，整批只需启动 max_workers 次exiftool。
+        写入过程中只显示进度条，警告和错误在结束后统一输出。
+        
         Args:
             descriptions: 图片路径和描述的字典
             screenshot_mode: 是否使用截图模式
+            max_workers: 同时写入的文件数
         """
-        results = {}
+        from tqdm import tqdm
         
-        for i, (image_path, description) in enumerate(descriptions.items(), 1):
-            print(f"[{i}/{len(descriptions)}] 写入metadata: {os.path.basename(image_path)}")
-            success = self.write_metadata(image_path, description, screenshot_mode)
-            results[image_path] = success
+        # 结果按输入顺序排列
+        results = dict.fromkeys(descriptions, False)
+        messages = []
         
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self.write_metadata, image_path, description, screenshot_mode,
+                                messages=messages): image_path
+                for image_path, description in descriptions.items()
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="写入metadata",
+                               unit="张", mininterval=0.5):
+                results[futures[future]] = future.result()
+        
+        for message in messages:
+            print(message)
+        print(f"✅ 写入成功 {sum(results.values())}/{len(results)} 张")
         return results
     
     def trigger_spotlight_reindex(self, directory: str):
-        """触发Spotlight重新索引指定目录"""
+        """触发Spotlight重新索引指定目录
+        
+        mdimport在后台运行，不等待索引完成（大型图库可能需要数分钟）；程序退出后它会继续执行。
+        """
         try:
             cmd = ['mdimport', '-r', directory]
-            subprocess.run(cmd, check=True, capture_output=True)
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             print(f"✅ 已触发Spotlight重新索引: {directory}")
-        except subprocess.CalledProcessError:
-            print("⚠️  触发Spotlight重新索引失败，但metadata已写入")
\ No newline at end of file
+        except OSError:
+            print("⚠️  触发Spotlight重新索引失败，但metadata已写入")
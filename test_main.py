@@ -3,31 +3,65 @@
 测试文件，用于验证 main.py 的主要功能
 确保修改后的逐张处理逻辑正常工作
 """
+import base64
+import hashlib
+import json
+import logging
 import os
 import sys
 import tempfile
+import threading
 import unittest
 from unittest.mock import Mock, patch, MagicMock, call
 from pathlib import Path
 import shutil
+import stat
 
 # 添加当前目录到 Python 路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from main import find_images, main
+from main import (analyze_with_cache, find_images, find_images_in_paths, iter_images, PathResolver, main,
+                  start_log_listener, stop_log_listener)
+from metadata import MetadataWriter, _stat_access
+from cache import AnalysisCache, MetadataIndex, file_sha1
 from config import SUPPORTED_IMAGE_FORMATS
 
+# Linux上测试目录放在内存文件系统中，创建和删除不产生磁盘I/O；其他系统使用默认临时目录
+# （假exiftool脚本需要执行权限，/dev/shm 可能以noexec挂载，仍放在默认临时目录）
+FIXTURE_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def setUpModule():
+    # 测试图片都是内容相同的空文件，使用真实缓存会互相命中，这里统一让缓存未命中
+    # （同时避免测试读写用户目录下的缓存数据库）
+    patcher = patch('main.AnalysisCache')
+    mock_cache_class = patcher.start()
+    mock_cache_class.return_value.get.return_value = None
+    patcher = patch('main.MetadataIndex')
+    mock_index_class = patcher.start()
+    mock_index_class.return_value.lookup.return_value = {}
+
+
+def tearDownModule():
+    patch.stopall()
+
+
+def touch(path):
+    """创建空文件（不像 Path.touch 那样额外调用 utime）"""
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o644))
+
 
 class TestFindImages(unittest.TestCase):
     """测试图片查找功能"""
     
-    def setUp(self):
-        """创建临时测试目录"""
-        self.test_dir = tempfile.mkdtemp()
-        self.addCleanup(shutil.rmtree, self.test_dir)
+    @classmethod
+    def setUpClass(cls):
+        """创建临时测试目录（各测试只读取这些文件，整个类共用一份）"""
+        cls.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        cls.addClassCleanup(shutil.rmtree, cls.test_dir)
         
         # 创建测试文件
-        self.test_files = [
+        cls.test_files = [
             'image1.jpg',
             'image2.png', 
             'image3.jpeg',
@@ -36,10 +70,11 @@ class TestFindImages(unittest.TestCase):
             'subdir/image5.gif'
         ]
         
-        for file_path in self.test_files:
-            full_path = Path(self.test_dir) / file_path
-            full_path.parent.mkdir(parents=True, exist_ok=True)
-            full_path.touch()
+        # 每个目录只创建一次
+        for dir_path in {os.path.dirname(f) for f in cls.test_files} - {''}:
+            os.makedirs(os.path.join(cls.test_dir, dir_path), exist_ok=True)
+        for file_path in cls.test_files:
+            touch(os.path.join(cls.test_dir, file_path))
     
     def test_find_images_recursive(self):
         """测试递归查找图片"""
@@ -74,6 +109,10 @@ class TestFindImages(unittest.TestCase):
         for img in images:
             self.assertNotIn('subdir', img)
     
+    def test_iter_images_matches_find_images(self):
+        """测试生成器产出的图片与排序后的列表一致"""
+        self.assertEqual(sorted(iter_images(self.test_dir)), find_images(self.test_dir))
+    
     def test_find_images_nonexistent_directory(self):
         """测试不存在的目录"""
         with self.assertRaises(FileNotFoundError):
@@ -81,28 +120,87 @@ class TestFindImages(unittest.TestCase):
     
     def test_find_images_file_instead_of_directory(self):
         """测试传入文件而不是目录"""
-        test_file = os.path.join(self.test_dir, 'test.txt')
-        Path(test_file).touch()
+        test_file = os.path.join(self.test_dir, 'not_image.txt')
         
         with self.assertRaises(ValueError):
             find_images(test_file)
 
 
+class TestPathResolver(unittest.TestCase):
+    """测试显示路径计算"""
+    
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.sub_dir = os.path.join(self.test_dir, 'sub')
+        os.makedirs(self.sub_dir)
+        self.single_file = os.path.join(self.test_dir, 'single.jpg')
+        touch(self.single_file)
+    
+    def test_longest_directory_match_wins(self):
+        """测试嵌套目录时使用最长匹配的目录作为基准"""
+        resolver = PathResolver([self.test_dir, self.sub_dir])
+        image_file = os.path.join(self.sub_dir, 'a.jpg')
+        
+        relative_path, base_dir = resolver.resolve(image_file)
+        
+        self.assertEqual(relative_path, 'a.jpg')
+        self.assertEqual(base_dir, self.sub_dir)
+    
+    def test_single_file_uses_basename(self):
+        """测试单个文件输入显示文件名"""
+        resolver = PathResolver([self.single_file])
+        
+        relative_path, base_dir = resolver.resolve(self.single_file)
+        
+        self.assertEqual(relative_path, 'single.jpg')
+        self.assertEqual(base_dir, self.test_dir)
+    
+    def test_scan_result_lookup(self):
+        """测试登记扫描结果后直接返回扫描时确定的显示路径"""
+        resolver = PathResolver([self.test_dir + os.sep])
+        image_file = os.path.join(self.sub_dir, 'a.jpg')
+        resolver.add_scan_result(self.test_dir + os.sep, [image_file])
+        
+        relative_path, base_dir = resolver.resolve(image_file)
+        
+        self.assertEqual(relative_path, os.path.join('sub', 'a.jpg'))
+        self.assertEqual(base_dir, self.test_dir + os.sep)
+    
+    def test_relative_input_path(self):
+        """测试以相对路径输入目录时也能计算相对路径"""
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.test_dir)
+        resolver = PathResolver(['sub'])
+        
+        relative_path, base_dir = resolver.resolve(os.path.join('sub', 'a.jpg'))
+        
+        self.assertEqual(relative_path, 'a.jpg')
+        self.assertEqual(base_dir, 'sub')
+    
+    def test_directory_prefix_does_not_match_sibling(self):
+        """测试 /foo 不会匹配 /foobar 下的文件"""
+        resolver = PathResolver([self.sub_dir])
+        sibling_file = self.sub_dir + 'bar' + os.sep + 'a.jpg'
+        
+        self.assertEqual(resolver.resolve(sibling_file), (sibling_file, None))
+
+
 class TestMainFunction(unittest.TestCase):
     """测试主函数的逐张处理逻辑"""
     
     def setUp(self):
         """设置测试环境"""
-        self.test_dir = tempfile.mkdtemp()
+        self.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
         self.addCleanup(shutil.rmtree, self.test_dir)
         
         # 创建测试图片文件
         self.test_images = ['img1.jpg', 'img2.png', 'img3.jpeg']
         for img in self.test_images:
-            (Path(self.test_dir) / img).touch()
+            touch(os.path.join(self.test_dir, img))
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_dry_run_mode(self, mock_metadata_writer, mock_image_analyzer):
         """测试预览模式"""
         # 设置 mock
@@ -113,8 +211,7 @@ class TestMainFunction(unittest.TestCase):
         mock_analyzer_instance.analyze_image.return_value = "测试描述"
         mock_image_analyzer.return_value = mock_analyzer_instance
         
-        mock_writer_instance.parse_description.return_value = {'summary': '测试'}
-        mock_writer_instance.extract_keywords.return_value = ['测试', '关键词']
+        mock_writer_instance.analyze_description.return_value = ({'summary': '测试'}, ['测试', '关键词'])
         
         # 修改 sys.argv
         with patch('sys.argv', ['main.py', self.test_dir, '--dry-run']):
@@ -124,8 +221,8 @@ class TestMainFunction(unittest.TestCase):
         # 在预览模式下不应该调用写入方法
         mock_writer_instance.write_metadata.assert_not_called()
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_skip_existing_metadata(self, mock_metadata_writer, mock_image_analyzer):
         """测试跳过已有 metadata 的图片"""
         mock_writer_instance = Mock()
@@ -135,15 +232,14 @@ class TestMainFunction(unittest.TestCase):
         mock_image_analyzer.return_value = mock_analyzer_instance
         
         # 模拟第一张图片已有 metadata，第二张没有
-        mock_writer_instance.verify_metadata.side_effect = [
-            {'description': '已有描述'},  # img1.jpg 已有 metadata
-            None,  # img2.png 没有 metadata
-            None   # img3.jpeg 没有 metadata
-        ]
+        mock_writer_instance.verify_metadata_batch.return_value = {
+            os.path.join(self.test_dir, 'img1.jpg'): {'description': '已有描述'},  # img1.jpg 已有 metadata
+            os.path.join(self.test_dir, 'img2.png'): {},  # img2.png 没有 metadata
+            os.path.join(self.test_dir, 'img3.jpeg'): {}  # img3.jpeg 没有 metadata
+        }
         
         mock_analyzer_instance.analyze_image.return_value = "新描述"
-        mock_writer_instance.parse_description.return_value = {'summary': '新描述'}
-        mock_writer_instance.extract_keywords.return_value = ['关键词']
+        mock_writer_instance.analyze_description.return_value = ({'summary': '新描述'}, ['关键词'])
         mock_writer_instance.write_metadata.return_value = True
         mock_writer_instance.trigger_spotlight_reindex = Mock()
         
@@ -156,8 +252,8 @@ class TestMainFunction(unittest.TestCase):
         self.assertEqual(mock_analyzer_instance.analyze_image.call_count, 2)
         self.assertEqual(mock_writer_instance.write_metadata.call_count, 2)
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_force_mode_reprocess_all(self, mock_metadata_writer, mock_image_analyzer):
         """测试强制模式重新处理所有图片"""
         mock_writer_instance = Mock()
@@ -167,10 +263,11 @@ class TestMainFunction(unittest.TestCase):
         mock_image_analyzer.return_value = mock_analyzer_instance
         
         # 即使有 metadata 也应该重新处理
-        mock_writer_instance.verify_metadata.return_value = {'description': '旧描述'}
+        mock_writer_instance.verify_metadata_batch.return_value = {
+            os.path.join(self.test_dir, img): {'description': '旧描述'} for img in self.test_images
+        }
         mock_analyzer_instance.analyze_image.return_value = "新描述"
-        mock_writer_instance.parse_description.return_value = {'summary': '新描述'}
-        mock_writer_instance.extract_keywords.return_value = ['关键词']
+        mock_writer_instance.analyze_description.return_value = ({'summary': '新描述'}, ['关键词'])
         mock_writer_instance.write_metadata.return_value = True
         mock_writer_instance.trigger_spotlight_reindex = Mock()
         
@@ -179,23 +276,109 @@ class TestMainFunction(unittest.TestCase):
         
         self.assertEqual(result, 0)
         
-        # 验证所有图片都被分析
+        # 验证所有图片都被分析，且不检查已有 metadata
         self.assertEqual(mock_analyzer_instance.analyze_image.call_count, 3)
         self.assertEqual(mock_writer_instance.write_metadata.call_count, 3)
+        mock_writer_instance.verify_metadata_batch.assert_not_called()
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
+    def test_dedup_analyzes_identical_images_once(self, mock_metadata_writer, mock_image_analyzer):
+        """测试 --dedup 时内容相同的图片只分析一次，描述写入所有副本"""
+        mock_writer_instance = Mock()
+        mock_analyzer_instance = Mock()
+        mock_metadata_writer.return_value = mock_writer_instance
+        mock_image_analyzer.return_value = mock_analyzer_instance
+        
+        # 测试图片都是空文件，内容相同
+        mock_writer_instance.verify_metadata_batch.return_value = {}
+        mock_analyzer_instance.analyze_image.return_value = "测试描述"
+        mock_writer_instance.analyze_description.return_value = ({'summary': '测试描述'}, ['测试'])
+        mock_writer_instance.write_metadata.return_value = True
+        
+        with patch('sys.argv', ['main.py', self.test_dir, '--dedup']), \
+                patch('main.file_sha1', wraps=file_sha1) as mock_sha1:
+            result = main()
+        
+        self.assertEqual(result, 0)
+        self.assertEqual(mock_analyzer_instance.analyze_image.call_count, 1)
+        # 分组时算出的哈希直接用于查询缓存，每个文件只读取一次
+        self.assertEqual(mock_sha1.call_count, len(self.test_images))
+        written = sorted(c.args[0] for c in mock_writer_instance.write_metadata.call_args_list)
+        self.assertEqual(written, sorted(os.path.join(self.test_dir, img) for img in self.test_images))
+    
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
+    def test_group_by_dir_analyzes_directory_in_one_request(self, mock_metadata_writer, mock_image_analyzer):
+        """测试 --group-by-dir 时同一目录的图片合并分析，只写入成功分析的图片"""
+        mock_writer_instance = Mock()
+        mock_analyzer_instance = Mock()
+        mock_metadata_writer.return_value = mock_writer_instance
+        mock_image_analyzer.return_value = mock_analyzer_instance
+        
+        img1, img2 = (os.path.join(self.test_dir, name) for name in ('img1.jpg', 'img2.png'))
+        mock_writer_instance.verify_metadata_batch.return_value = {}
+        mock_analyzer_instance.analyze_group.return_value = {img1: "描述1", img2: "描述2"}
+        mock_writer_instance.analyze_description.return_value = ({'summary': '描述'}, ['描述'])
+        mock_writer_instance.write_metadata.return_value = True
+        
+        with patch('sys.argv', ['main.py', self.test_dir, '--group-by-dir']):
+            result = main()
+        
+        self.assertEqual(result, 0)
+        mock_analyzer_instance.analyze_image.assert_not_called()
+        mock_analyzer_instance.analyze_group.assert_called_once()
+        self.assertEqual(len(mock_analyzer_instance.analyze_group.call_args[0][0]), 3)
+        written = sorted(c.args[0] for c in mock_writer_instance.write_metadata.call_args_list)
+        self.assertEqual(written, [img1, img2])
+    
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
+    def test_analysis_starts_while_scanning(self, mock_metadata_writer, mock_image_analyzer):
+        """测试扫描尚未结束时已找到的图片就开始分析"""
+        mock_writer_instance = Mock()
+        mock_analyzer_instance = Mock()
+        mock_metadata_writer.return_value = mock_writer_instance
+        mock_image_analyzer.return_value = mock_analyzer_instance
+        
+        analyzed = threading.Event()
+        mock_analyzer_instance.analyze_image.side_effect = lambda *args: analyzed.set() or "测试描述"
+        mock_writer_instance.verify_metadata_batch.return_value = {}
+        mock_writer_instance.analyze_description.return_value = ({'summary': '测试描述'}, ['测试'])
+        mock_writer_instance.write_metadata.return_value = True
+        
+        # 产出第一张图片后等待它被分析，再继续“扫描”
+        overlapped = []
+        
+        def slow_iter_images(path, recursive=True):
+            images = list(iter_images(path, recursive))
+            
+            def generate():
+                yield images[0]
+                overlapped.append(analyzed.wait(5))
+                yield from images[1:]
+            return generate()
+        
+        with patch('main.STREAM_BATCH_SIZE', 1), patch('main.iter_images', slow_iter_images), \
+                patch('sys.argv', ['main.py', self.test_dir]):
+            result = main()
+        
+        self.assertEqual(result, 0)
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(mock_analyzer_instance.analyze_image.call_count, 3)
+    
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_verify_mode(self, mock_metadata_writer, mock_image_analyzer):
         """测试验证模式"""
         mock_writer_instance = Mock()
         mock_metadata_writer.return_value = mock_writer_instance
         
         # 模拟验证结果
-        mock_writer_instance.verify_metadata.side_effect = [
-            {'description': '描述1', 'keywords': '关键词1'},
-            None,
-            {'description': '描述3'}
-        ]
+        mock_writer_instance.verify_metadata_batch.return_value = {
+            os.path.join(self.test_dir, 'img1.jpg'): {'description': '描述1', 'keywords': '关键词1'},
+            os.path.join(self.test_dir, 'img3.jpeg'): {'description': '描述3'}
+        }
         
         with patch('sys.argv', ['main.py', self.test_dir, '--verify']):
             result = main()
@@ -205,18 +388,22 @@ class TestMainFunction(unittest.TestCase):
         # 验证模式不应该初始化 ImageAnalyzer
         mock_image_analyzer.assert_not_called()
         
-        # 应该调用 verify_metadata 检查每张图片
-        self.assertEqual(mock_writer_instance.verify_metadata.call_count, 3)
+        # 所有图片一次性批量验证，不再逐张调用 verify_metadata
+        mock_writer_instance.verify_metadata_batch.assert_called_once()
+        self.assertEqual(len(mock_writer_instance.verify_metadata_batch.call_args[0][0]), 3)
+        mock_writer_instance.verify_metadata.assert_not_called()
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_all_images_have_metadata(self, mock_metadata_writer, mock_image_analyzer):
         """测试所有图片都有 metadata 的情况"""
         mock_writer_instance = Mock()
         mock_metadata_writer.return_value = mock_writer_instance
         
         # 所有图片都有 metadata
-        mock_writer_instance.verify_metadata.return_value = {'description': '已有描述'}
+        mock_writer_instance.verify_metadata_batch.return_value = {
+            os.path.join(self.test_dir, img): {'description': '已有描述'} for img in self.test_images
+        }
         
         with patch('sys.argv', ['main.py', self.test_dir]):
             result = main()
@@ -226,16 +413,17 @@ class TestMainFunction(unittest.TestCase):
         # 不应该初始化 ImageAnalyzer
         mock_image_analyzer.assert_not_called()
         
-        # 应该检查所有图片的 metadata
-        self.assertEqual(mock_writer_instance.verify_metadata.call_count, 3)
+        # 应该一次性批量检查所有图片的 metadata
+        mock_writer_instance.verify_metadata_batch.assert_called_once()
+        self.assertEqual(len(mock_writer_instance.verify_metadata_batch.call_args[0][0]), 3)
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_analyzer_initialization_failure(self, mock_metadata_writer, mock_image_analyzer):
         """测试图片分析器初始化失败"""
         mock_writer_instance = Mock()
         mock_metadata_writer.return_value = mock_writer_instance
-        mock_writer_instance.verify_metadata.return_value = None
+        mock_writer_instance.verify_metadata_batch.return_value = {}
         
         # 模拟初始化失败
         mock_image_analyzer.side_effect = ValueError("API key not found")
@@ -247,7 +435,7 @@ class TestMainFunction(unittest.TestCase):
     
     def test_no_images_found(self):
         """测试没有找到图片文件的情况"""
-        empty_dir = tempfile.mkdtemp()
+        empty_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
         self.addCleanup(shutil.rmtree, empty_dir)
         
         with patch('sys.argv', ['main.py', empty_dir]):
@@ -255,10 +443,10 @@ class TestMainFunction(unittest.TestCase):
         
         self.assertEqual(result, 1)
     
-    @patch('main.find_images')
-    def test_keyboard_interrupt(self, mock_find_images):
+    @patch('main.iter_images')
+    def test_keyboard_interrupt(self, mock_iter_images):
         """测试用户中断"""
-        mock_find_images.side_effect = KeyboardInterrupt()
+        mock_iter_images.side_effect = KeyboardInterrupt()
         
         with patch('sys.argv', ['main.py', self.test_dir]):
             result = main()
@@ -269,23 +457,32 @@ class TestMainFunction(unittest.TestCase):
 class TestMultipleDirectories(unittest.TestCase):
     """测试多目录处理功能"""
     
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         # 创建两个测试目录
-        self.test_dir1 = tempfile.mkdtemp()
-        self.test_dir2 = tempfile.mkdtemp()
-        self.addCleanup(shutil.rmtree, self.test_dir1)
-        self.addCleanup(shutil.rmtree, self.test_dir2)
+        cls.test_dir1 = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        cls.test_dir2 = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        cls.addClassCleanup(shutil.rmtree, cls.test_dir1)
+        cls.addClassCleanup(shutil.rmtree, cls.test_dir2)
         
         # 目录1中创建2张图片
         for i in range(1, 3):
-            (Path(self.test_dir1) / f'img{i}.jpg').touch()
+            touch(os.path.join(cls.test_dir1, f'img{i}.jpg'))
         
         # 目录2中创建3张图片
         for i in range(3, 6):
-            (Path(self.test_dir2) / f'img{i}.jpg').touch()
+            touch(os.path.join(cls.test_dir2, f'img{i}.jpg'))
+    
+    def test_find_images_in_paths_keeps_order(self):
+        """测试并发扫描多个目录时结果顺序与输入一致"""
+        results = find_images_in_paths([self.test_dir2, self.test_dir1])
+        
+        self.assertEqual([path for path, _ in results], [self.test_dir2, self.test_dir1])
+        self.assertEqual(len(results[0][1]), 3)
+        self.assertEqual(len(results[1][1]), 2)
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_multiple_directories(self, mock_metadata_writer, mock_image_analyzer):
         """测试多目录处理"""
         mock_writer_instance = Mock()
@@ -295,10 +492,9 @@ class TestMultipleDirectories(unittest.TestCase):
         mock_image_analyzer.return_value = mock_analyzer_instance
         
         # 所有图片都没有metadata
-        mock_writer_instance.verify_metadata.return_value = None
+        mock_writer_instance.verify_metadata_batch.return_value = {}
         mock_analyzer_instance.analyze_image.return_value = "测试描述"
-        mock_writer_instance.parse_description.return_value = {'summary': '测试'}
-        mock_writer_instance.extract_keywords.return_value = ['关键词']
+        mock_writer_instance.analyze_description.return_value = ({'summary': '测试'}, ['关键词'])
         mock_writer_instance.write_metadata.return_value = True
         mock_writer_instance.trigger_spotlight_reindex = Mock()
         
@@ -320,16 +516,17 @@ class TestMultipleDirectories(unittest.TestCase):
 class TestProgressiveProcessing(unittest.TestCase):
     """测试逐张处理的逻辑"""
     
-    def setUp(self):
-        self.test_dir = tempfile.mkdtemp()
-        self.addCleanup(shutil.rmtree, self.test_dir)
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        cls.addClassCleanup(shutil.rmtree, cls.test_dir)
         
         # 创建5张测试图片
         for i in range(1, 6):
-            (Path(self.test_dir) / f'img{i}.jpg').touch()
+            touch(os.path.join(cls.test_dir, f'img{i}.jpg'))
     
-    @patch('main.ImageAnalyzer')
-    @patch('main.MetadataWriter')
+    @patch('vision.ImageAnalyzer')
+    @patch('metadata.MetadataWriter')
     def test_progressive_processing_order(self, mock_metadata_writer, mock_image_analyzer):
         """测试逐张处理的顺序"""
         mock_writer_instance = Mock()
@@ -339,18 +536,14 @@ class TestProgressiveProcessing(unittest.TestCase):
         mock_image_analyzer.return_value = mock_analyzer_instance
         
         # 模拟前两张有 metadata，后三张没有
-        verify_results = [
-            {'description': '描述1'},  # img1.jpg 有
-            {'description': '描述2'},  # img2.jpg 有  
-            None,  # img3.jpg 没有
-            None,  # img4.jpg 没有
-            None   # img5.jpg 没有
-        ]
-        mock_writer_instance.verify_metadata.side_effect = verify_results
+        verify_results = {
+            os.path.join(self.test_dir, 'img1.jpg'): {'description': '描述1'},  # img1.jpg 有
+            os.path.join(self.test_dir, 'img2.jpg'): {'description': '描述2'},  # img2.jpg 有
+        }
+        mock_writer_instance.verify_metadata_batch.return_value = verify_results
         
         mock_analyzer_instance.analyze_image.return_value = "新描述"
-        mock_writer_instance.parse_description.return_value = {'summary': '新描述'}
-        mock_writer_instance.extract_keywords.return_value = ['关键词']
+        mock_writer_instance.analyze_description.return_value = ({'summary': '新描述'}, ['关键词'])
         mock_writer_instance.write_metadata.return_value = True
         mock_writer_instance.trigger_spotlight_reindex = Mock()
         
@@ -359,14 +552,456 @@ class TestProgressiveProcessing(unittest.TestCase):
         
         self.assertEqual(result, 0)
         
-        # 验证 verify_metadata 按顺序调用了所有图片
-        self.assertEqual(mock_writer_instance.verify_metadata.call_count, 5)
+        # 验证一次性按顺序批量检查了所有图片
+        mock_writer_instance.verify_metadata_batch.assert_called_once_with(
+            [os.path.join(self.test_dir, f'img{i}.jpg') for i in range(1, 6)]
+        )
         
         # 验证只处理了没有 metadata 的3张图片
         self.assertEqual(mock_analyzer_instance.analyze_image.call_count, 3)
         self.assertEqual(mock_writer_instance.write_metadata.call_count, 3)
 
 
+class TestMetadataWriter(unittest.TestCase):
+    """测试 MetadataWriter 的 exiftool 调用逻辑（不依赖真实 exiftool）"""
+    
+    def setUp(self):
+        with patch('metadata.shutil.which', return_value='/usr/local/bin/exiftool'):
+            self.writer = MetadataWriter()
+    
+    @patch('metadata.subprocess.run')
+    def test_verify_metadata_batch_chunks_and_maps_results(self, mock_run):
+        """测试批量验证按块调用 exiftool 并按 SourceFile 映射结果"""
+        paths = [f'/photos/img{i}.jpg' for i in range(3)]
+        
+        def fake_run(cmd, **kwargs):
+            files = [arg for arg in cmd if arg.startswith('/photos/')]
+            data = [{'SourceFile': f} for f in files]
+            if '/photos/img0.jpg' in files:
+                data[0]['ImageDescription'] = '主要内容：海边日落风景照'
+            return Mock(returncode=0, stdout=json.dumps(data))
+        
+        mock_run.side_effect = fake_run
+        results = self.writer.verify_metadata_batch(paths, chunk_size=2)
+        
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertEqual(results['/photos/img0.jpg'], {'ImageDescription': '主要内容：海边日落风景照'})
+        self.assertEqual(results['/photos/img1.jpg'], {})
+        self.assertEqual(results['/photos/img2.jpg'], {})
+
+    def test_parse_description_fields(self):
+        """测试结构化描述的解析：忽略缩进、空行和未知前缀，截图模式使用各自的字段"""
+        description = '  主要内容：海边日落风景照\n\n对象：太阳 海浪\r\n文字：无\n其他：忽略'
+        self.assertEqual(self.writer.parse_description(description), {
+            'summary': '海边日落风景照', 'objects': '太阳 海浪', 'text': '无'})
+        self.assertEqual(
+            self.writer.parse_description_screenshot('文字内容：微信 通讯录\n应用信息：微信'),
+            {'text_content': '微信 通讯录', 'app_info': '微信'})
+        self.assertEqual(
+            sorted(self.writer.extract_keywords(description)),
+            sorted(['海边日落风景照', '太阳', '海浪']))
+
+    def test_extract_keywords_splits_on_cjk_punctuation(self):
+        """测试关键词按中文标点分词，但不拆开时间、数字等英文标点"""
+        keywords = self.writer.extract_keywords_screenshot('文字内容：你好、世界！收到了（已读） 10:30 3.14')
+        self.assertEqual(sorted(keywords), sorted(['你好', '世界', '收到了', '已读', '10:30', '3.14']))
+
+    def test_write_metadata_restores_from_exiftool_backup(self):
+        """测试写入后文件损坏时用 exiftool 的 _original 备份恢复"""
+        test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, test_dir)
+        image_path = os.path.join(test_dir, 'a.jpg')
+        with open(image_path, 'wb') as f:
+            f.write(b'original')
+
+        def fake_run(cmd, timeout=30):
+            # 模拟 exiftool：原文件改名为 _original，写出的新文件为空
+            os.rename(image_path, image_path + '_original')
+            open(image_path, 'wb').close()
+            return True, ''
+
+        with patch.object(self.writer, '_run_exiftool', side_effect=fake_run):
+            self.assertFalse(self.writer.write_metadata(image_path, '主要内容：测试'))
+
+        with open(image_path, 'rb') as f:
+            self.assertEqual(f.read(), b'original')
+        self.assertFalse(os.path.exists(image_path + '_original'))
+
+    def test_write_metadata_reports_error_without_backup(self):
+        """测试备份已清理后出错时报告原始错误，而不是声称从备份恢复"""
+        test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, test_dir)
+        image_path = os.path.join(test_dir, 'a.jpg')
+        with open(image_path, 'wb') as f:
+            f.write(b'original')
+        os.utime(image_path, ns=(1_000_000_000_000_000_000, 1_000_000_000_000_000_000))
+        
+        def fake_run(cmd, timeout=30):
+            # 模拟 exiftool -overwrite_original：直接改写文件，不留备份
+            with open(image_path, 'ab') as f:
+                f.write(b' with metadata')
+            return True, ''
+        
+        messages = []
+        with patch.object(self.writer, '_run_exiftool', side_effect=fake_run), \
+                patch('metadata.os.utime', side_effect=PermissionError('utime denied')):
+            self.assertFalse(self.writer.write_metadata(image_path, '主要内容：测试', messages=messages))
+        
+        self.assertEqual(len(messages), 1)
+        self.assertIn('utime denied', messages[0])
+        self.assertNotIn('从备份恢复', messages[0])
+        with open(image_path, 'rb') as f:
+            self.assertEqual(f.read(), b'original with metadata')
+    
+    def test_stat_access_checks_owner_files(self):
+        """测试自己的文件：没有写权限位时直接判定不可写，权限位允许时仍由 os.access 确认（ACL等）"""
+        def owned_stat(mode):
+            # (st_mode, st_ino, st_dev, st_nlink, st_uid, st_gid, st_size, st_atime, st_mtime, st_ctime)
+            return os.stat_result((stat.S_IFREG | mode, 0, 0, 1, 1000, 1000, 8, 0, 0, 0))
+        
+        with patch('metadata.os.geteuid', return_value=1000, create=True), \
+                patch('metadata.os.access') as mock_access:
+            self.assertEqual(_stat_access('/photos/a.jpg', owned_stat(0o444)), (True, False))
+            mock_access.assert_not_called()
+            
+            # 权限位可写，但ACL拒绝写入
+            mock_access.side_effect = lambda path, mode: mode == os.R_OK
+            self.assertEqual(_stat_access('/photos/a.jpg', owned_stat(0o644)), (True, False))
+    
+    def test_write_metadata_keeps_original_times(self):
+        """测试写入成功后文件时间与写入前一致，并清理 _original 备份"""
+        test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, test_dir)
+        image_path = os.path.join(test_dir, 'a.jpg')
+        with open(image_path, 'wb') as f:
+            f.write(b'original')
+        os.utime(image_path, ns=(1_000_000_000_000_000_000, 1_000_000_000_000_000_000))
+
+        def fake_run(cmd, timeout=30):
+            os.rename(image_path, image_path + '_original')
+            with open(image_path, 'wb') as f:
+                f.write(b'with metadata')
+            return True, ''
+
+        with patch.object(self.writer, '_run_exiftool', side_effect=fake_run):
+            self.assertTrue(self.writer.write_metadata(image_path, '主要内容：测试'))
+
+        self.assertEqual(os.stat(image_path).st_mtime_ns, 1_000_000_000_000_000_000)
+        self.assertFalse(os.path.exists(image_path + '_original'))
+
+    def test_display_path_relative_to_base_dir(self):
+        """测试显示路径：基准目录下的文件显示相对路径，其余只显示文件名"""
+        self.assertEqual(self.writer._get_display_path('/photos/2024/a.jpg', '/photos'),
+                         os.path.join('2024', 'a.jpg'))
+        self.assertEqual(self.writer._get_display_path('/photosbar/a.jpg', '/photos'), 'a.jpg')
+        self.assertEqual(self.writer._get_display_path('/photos/a.jpg'), 'a.jpg')
+
+    def test_analyze_description_cached_per_mode(self):
+        """测试相同描述只解析一次，不同模式分开缓存，返回值可以安全修改"""
+        description = '主要内容：海边日落风景照\n文字内容：你好'
+        with patch.object(self.writer, 'parse_description', wraps=self.writer.parse_description) as parse:
+            parsed, keywords = self.writer.analyze_description(description)
+            parsed['summary'] = '已修改'
+            keywords.clear()
+            self.assertEqual(self.writer.analyze_description(description),
+                             ({'summary': '海边日落风景照'}, ['海边日落风景照']))
+            self.assertEqual(parse.call_count, 1)
+
+        parsed, _ = self.writer.analyze_description(description, screenshot_mode=True)
+        self.assertEqual(parsed['text_content'], '你好')
+
+    def test_stay_open_process_reused_and_escapes_newlines(self):
+        """测试常驻 exiftool 进程复用、换行转义以及错误识别"""
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_exiftool = os.path.join(fake_dir, 'exiftool')
+        log_path = os.path.join(fake_dir, 'calls.log')
+        with open(fake_exiftool, 'w') as f:
+            f.write(FAKE_STAY_OPEN_EXIFTOOL.format(python=sys.executable, log=log_path))
+        os.chmod(fake_exiftool, 0o755)
+        
+        with patch.dict(os.environ, {'PATH': fake_dir + os.pathsep + os.environ['PATH']}):
+            ok, _ = self.writer._run_exiftool(['-Subject=第一行\n第二行', 'good.jpg'])
+            failed, stderr = self.writer._run_exiftool(['-Subject=x', 'bad.jpg'])
+            self.writer.close()
+        
+        self.assertTrue(ok)
+        self.assertFalse(failed)
+        self.assertIn('Error', stderr)
+        with open(log_path) as f:
+            calls = f.read().splitlines()
+        # 两条命令由同一个进程处理
+        self.assertEqual(len(set(line.split('|')[0] for line in calls)), 1)
+        self.assertIn('#[CSTR]-Subject=第一行\\n第二行', calls[0])
+    
+    def test_each_thread_gets_its_own_exiftool_process(self):
+        """测试不同线程使用各自的常驻 exiftool 进程，可以并发写入"""
+        fake_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fake_dir)
+        fake_exiftool = os.path.join(fake_dir, 'exiftool')
+        log_path = os.path.join(fake_dir, 'calls.log')
+        with open(fake_exiftool, 'w') as f:
+            f.write(FAKE_STAY_OPEN_EXIFTOOL.format(python=sys.executable, log=log_path))
+        os.chmod(fake_exiftool, 0o755)
+        
+        with patch.dict(os.environ, {'PATH': fake_dir + os.pathsep + os.environ['PATH']}):
+            self.writer._run_exiftool(['-Subject=x', 'main.jpg'])
+            worker = threading.Thread(target=self.writer._run_exiftool, args=(['-Subject=y', 'worker.jpg'],))
+            worker.start()
+            worker.join()
+            self.writer._run_exiftool(['-Subject=z', 'main2.jpg'])
+            self.writer.close()
+        
+        with open(log_path) as f:
+            pids = [line.split('|')[0] for line in f.read().splitlines()]
+        self.assertEqual(len(pids), 3)
+        self.assertEqual(pids[0], pids[2])
+        self.assertNotEqual(pids[0], pids[1])
+
+
+class TestImageEncoding(unittest.TestCase):
+    """测试发送给 Vision API 前的图片编码"""
+    
+    def setUp(self):
+        from vision import ImageAnalyzer
+        self.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        # 编码不需要 OpenAI 客户端，跳过 __init__ 中的 API key 检查
+        self.analyzer = ImageAnalyzer.__new__(ImageAnalyzer)
+    
+    def _encode(self, name, mode, fmt, size=(64, 64)):
+        from PIL import Image
+        image_path = os.path.join(self.test_dir, name)
+        Image.new(mode, size).save(image_path, fmt)
+        mime, data = self.analyzer.encode_image(image_path).split(';base64,')
+        with open(image_path, 'rb') as f:
+            return mime, base64.b64decode(data) == f.read()
+    
+    def test_small_files_in_target_format_pass_through(self):
+        """测试尺寸合规的RGB JPEG和带透明通道的PNG直接上传原文件"""
+        self.assertEqual(self._encode('a.jpg', 'RGB', 'JPEG'), ('data:image/jpeg', True))
+        self.assertEqual(self._encode('b.png', 'RGBA', 'PNG'), ('data:image/png', True))
+    
+    def test_non_image_files_rejected_before_decoding(self):
+        """测试空文件和内容不是图片的文件在交给PIL之前被拒绝"""
+        for name, content in (('empty.jpg', b''), ('text.png', b'not an image at all')):
+            image_path = os.path.join(self.test_dir, name)
+            with open(image_path, 'wb') as f:
+                f.write(content)
+            with patch('vision.Image.open') as mock_open:
+                with self.assertRaisesRegex(ValueError, '不是有效的图片文件'):
+                    self.analyzer.encode_image(image_path)
+                mock_open.assert_not_called()
+    
+    def test_unsupported_format_is_logged(self):
+        """测试跳过不支持的格式时通过vision日志输出"""
+        with self.assertLogs('vision', level='INFO') as logs:
+            self.assertIsNone(self.analyzer.analyze_image(os.path.join(self.test_dir, 'notes.txt')))
+        self.assertIn('跳过不支持的格式', logs.output[0])
+    
+    def test_other_images_are_reencoded(self):
+        """测试不透明PNG、CMYK JPEG和超大图片重新编码为JPEG"""
+        self.assertEqual(self._encode('c.png', 'RGB', 'PNG'), ('data:image/jpeg', False))
+        self.assertEqual(self._encode('d.jpg', 'CMYK', 'JPEG'), ('data:image/jpeg', False))
+        self.assertEqual(self._encode('e.jpg', 'RGB', 'JPEG', size=(2048, 64)), ('data:image/jpeg', False))
+
+
+class TestLogListener(unittest.TestCase):
+    """测试vision日志的输出方式"""
+    
+    def test_records_written_through_tqdm_and_detached_on_stop(self):
+        """测试日志通过 tqdm.write 输出，停止后vision日志恢复默认设置"""
+        logger = logging.getLogger('vision')
+        with patch('tqdm.tqdm.write') as mock_write:
+            listener = start_log_listener()
+            logger.info('已分析: a.jpg')
+            stop_log_listener(listener)
+        
+        mock_write.assert_called_once_with('已分析: a.jpg')
+        self.assertEqual(logger.handlers, [])
+        self.assertTrue(logger.propagate)
+
+
+class TestGroupAnalysis(unittest.TestCase):
+    """测试多张图片合并为一次请求的分析"""
+    
+    def setUp(self):
+        from vision import ImageAnalyzer
+        self.analyzer = ImageAnalyzer.__new__(ImageAnalyzer)
+        self.analyzer.client = Mock()
+        self.analyzer.encode_image = Mock(return_value='data:image/jpeg;base64,')
+    
+    def _reply(self, text):
+        return Mock(choices=[Mock(message=Mock(content=text))])
+    
+    def test_reply_split_per_image(self):
+        """测试回复按分节拆分到各图片，缺少分节的图片单独重新分析"""
+        paths = ['/photos/a.jpg', '/photos/b.jpg', '/photos/c.jpg']
+        self.analyzer.client.chat.completions.create.side_effect = [
+            self._reply("=== 图片1 ===\n主要内容：海边\n\n=== 图片2 ===\n主要内容：山峰"),
+            self._reply("主要内容：城市"),
+        ]
+        
+        results = self.analyzer.analyze_group(paths)
+        
+        self.assertEqual(results, {
+            '/photos/a.jpg': '主要内容：海边',
+            '/photos/b.jpg': '主要内容：山峰',
+            '/photos/c.jpg': '主要内容：城市',
+        })
+        calls = self.analyzer.client.chat.completions.create.call_args_list
+        self.assertEqual(len(calls), 2)
+        # 第一次请求包含提示词和全部三张图片
+        self.assertEqual(len(calls[0].kwargs['messages'][0]['content']), 4)
+        # 单独重新分析时复用已编码的图片
+        self.assertEqual(self.analyzer.encode_image.call_count, 3)
+
+    
+    def test_no_request_when_every_image_fails_to_encode(self):
+        """测试整组图片都编码失败时不发送API请求"""
+        self.analyzer.encode_image.side_effect = ValueError("无法读取图片")
+        
+        self.assertEqual(self.analyzer.analyze_group(['/photos/a.jpg', '/photos/b.jpg']), {})
+        self.analyzer.client.chat.completions.create.assert_not_called()
+
+
+class TestIgnoreMatcher(unittest.TestCase):
+    """测试 github_sync 同步时的忽略规则"""
+    
+    def test_default_patterns_skip_env_variants_and_workflows(self):
+        """测试默认规则忽略 .env 的各种变体和 .github，但保留 .env.example"""
+        from github_sync import DEFAULT_IGNORE_PATTERNS, build_ignore_matcher
+        is_ignored = build_ignore_matcher(DEFAULT_IGNORE_PATTERNS)
+        
+        for path in ('.env', '.env.local', '.env.bak', '.env.production', 'config/.env.local',
+                     '.git', '.git/HEAD', '.github/workflows/ci.yml', 'sub/__pycache__', 'a/b.pyc', '.DS_Store'):
+            self.assertTrue(is_ignored(path), path)
+        for path in ('.env.example', 'config/.env.example', 'main.py', 'environment.md', '.gitignore'):
+            self.assertFalse(is_ignored(path), path)
+
+
+class TestAnalysisCache(unittest.TestCase):
+    """测试分析结果缓存"""
+    
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.db_path = os.path.join(self.test_dir, 'cache', 'cache.sqlite')
+    
+    def test_results_persist_per_mode(self):
+        """测试结果按模式分开缓存，关闭后重新打开仍可读取"""
+        cache = AnalysisCache(self.db_path)
+        self.assertIsNone(cache.get('abc', False))
+        cache.put('abc', False, '普通描述')
+        # 未提交的结果同样可以命中
+        self.assertEqual(cache.get('abc', False), '普通描述')
+        self.assertIsNone(cache.get('abc', True))
+        cache.close()
+        
+        cache = AnalysisCache(self.db_path)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get('abc', False), '普通描述')
+        self.assertIsNone(cache.get('abc', True))
+    
+    def test_prompt_change_invalidates_results(self):
+        """测试修改提示词后旧的分析结果不再命中"""
+        cache = AnalysisCache(self.db_path)
+        cache.put('abc', False, '旧描述')
+        cache.close()
+        
+        with patch('cache.VISION_PROMPT', '新的提示词'):
+            cache = AnalysisCache(self.db_path)
+        self.addCleanup(cache.close)
+        self.assertIsNone(cache.get('abc', False))
+    
+    def test_refresh_ignores_cached_result(self):
+        """测试 --force 对应的 refresh 不读取缓存，但会用新结果更新缓存"""
+        cache = AnalysisCache(self.db_path)
+        self.addCleanup(cache.close)
+        image = os.path.join(self.test_dir, 'a.jpg')
+        Path(image).write_bytes(b'image')
+        cache.put(file_sha1(image), False, '旧描述')
+        analyzer = Mock()
+        analyzer.analyze_image.return_value = '新描述'
+        
+        self.assertEqual(analyze_with_cache(analyzer, cache, image, False), '旧描述')
+        analyzer.analyze_image.assert_not_called()
+        self.assertEqual(analyze_with_cache(analyzer, cache, image, False, refresh=True), '新描述')
+        self.assertEqual(cache.get(file_sha1(image), False), '新描述')
+    
+    def test_file_sha1_without_file_digest(self):
+        """测试没有 hashlib.file_digest（Python 3.11 以前）时分块计算的结果一致"""
+        path = os.path.join(self.test_dir, 'a.jpg')
+        Path(path).write_bytes(b'x' * (3 << 20))
+        expected = hashlib.sha1(b'x' * (3 << 20)).hexdigest()
+        self.assertEqual(file_sha1(path), expected)
+        with patch('cache.hashlib', Mock(spec=['sha1'], sha1=hashlib.sha1)):
+            self.assertEqual(file_sha1(path), expected)
+
+
+class TestMetadataIndex(unittest.TestCase):
+    """测试metadata状态索引"""
+    
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.db_path = os.path.join(self.test_dir, 'cache.sqlite')
+        self.image = os.path.join(self.test_dir, 'a.jpg')
+        Path(self.image).write_bytes(b'old')
+    
+    def test_changed_files_are_not_reported(self):
+        """测试文件大小或修改时间变化后记录失效"""
+        index = MetadataIndex(self.db_path)
+        index.update({self.image: True})
+        index.close()
+        
+        index = MetadataIndex(self.db_path)
+        self.addCleanup(index.close)
+        self.assertEqual(index.lookup([self.image]), {self.image: True})
+        
+        Path(self.image).write_bytes(b'changed')
+        self.assertEqual(index.lookup([self.image]), {})
+    
+    def test_lookup_queries_only_requested_paths_in_chunks(self):
+        """测试只查询传入的文件，路径数超过单条查询上限时分块查询"""
+        images = [os.path.join(self.test_dir, f'{name}.jpg') for name in 'bcde']
+        for image in images:
+            Path(image).write_bytes(b'data')
+        index = MetadataIndex(self.db_path)
+        index.update({images[0]: True, images[1]: False, images[2]: True, self.image: True})
+        index.close()
+        
+        index = MetadataIndex(self.db_path)
+        self.addCleanup(index.close)
+        with patch.object(MetadataIndex, 'LOOKUP_CHUNK', 2):
+            # images[3] 没有记录；self.image 有记录但没有请求
+            known = index.lookup(images)
+        self.assertEqual(known, {images[0]: True, images[1]: False, images[2]: True})
+
+
+# 模拟 exiftool -stay_open 协议的脚本：每条命令记录一行 "pid|参数"
+FAKE_STAY_OPEN_EXIFTOOL = """#!{python}
+import os, sys
+args = []
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line == 'False' and args[-1:] == ['-stay_open']:
+        break
+    if line.startswith('-execute'):
+        with open({log!r}, 'a') as log:
+            log.write('%d|%s\\n' % (os.getpid(), ' '.join(args)))
+        if 'bad.jpg' in args:
+            sys.stderr.write('Error: Not a valid JPG - bad.jpg\\n')
+        sys.stderr.write(args[args.index('-echo4') + 1] + '\\n')
+        sys.stderr.flush()
+        sys.stdout.write('{{ready%s}}\\n' % line[len('-execute'):])
+        sys.stdout.flush()
+        args = []
+    else:
+        args.append(line)
+"""
+
+
 if __name__ == '__main__':
     # 运行测试
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -1,129 +1,346 @@
 import base64
+import functools
+import io
+import logging
 import os
-from typing import Optional
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
 from PIL import Image
-from openai import OpenAI
-from config import OPENAI_API_KEY, VISION_PROMPT, SCREENSHOT_VISION_PROMPT, SUPPORTED_IMAGE_FORMATS
+from config import (
+    OPENAI_API_KEY, VISION_MODEL, VISION_PROMPT, SCREENSHOT_VISION_PROMPT, SUPPORTED_IMAGE_FORMATS,
+    VISION_CONCURRENCY, VISION_MAX_IMAGE_SIZE, VISION_JPEG_QUALITY, VISION_PASSTHROUGH_BYTES,
+    VISION_HQ_RESIZE, GROUP_VISION_PROMPT
+)
 
-# 启用HEIC/HEIF支持
-try:
-    from pillow_heif import register_heif_opener
+# 输出通过logging：main中由QueueHandler入队、后台线程统一写出，工作线程不争抢stdout锁
+log = logging.getLogger('vision')
+
+_HEIC_FORMATS = frozenset({'.heic', '.heif'})
+
+# JPEG、PNG、GIF的文件头；WebP为 RIFF....WEBP，HEIC/HEIF在第4字节处为 ftyp
+_IMAGE_MAGIC = (b'\xff\xd8\xff', b'\x89PNG', b'GIF8')
+
+
+def _looks_like_image(head: bytes) -> bool:
+    """根据文件前12个字节判断是否可能是支持的图片"""
+    return (head.startswith(_IMAGE_MAGIC)
+            or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+            or head[4:8] == b'ftyp')
+
+# 缩放滤镜：LANCZOS每个输出像素的采样点是BILINEAR的数倍，而缩放后还要以质量85重新编码，肉眼几乎看不出差别
+RESIZE_FILTER = Image.Resampling.LANCZOS if VISION_HQ_RESIZE else Image.Resampling.BILINEAR
+
+# 多图回复中每张图片的分节标记行，如 "=== 图片3 ==="
+_GROUP_SECTION_RE = re.compile(r'^[ \t]*=+[ \t]*图片[ \t]*(\d+)[ \t]*=+[ \t]*$', re.M)
+
+_thread_local = threading.local()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_pyvips():
+    """pyvips可选：安装了libvips时，超大图片的 解码→缩放→JPEG编码 由libvips流水线完成，比PIL快数倍且峰值内存更低
+    
+    加载libvips较慢，第一次需要缩放超大图片时才导入；不可用时返回None。
+    """
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        # 只装了pyvips而系统没有libvips时导入会报OSError
+        return None
+    return pyvips
+
+
+@functools.lru_cache(maxsize=1)
+def _heic_supported() -> bool:
+    """启用HEIC/HEIF支持（pillow-heif导入较慢，第一次遇到HEIC文件时才导入）"""
+    try:
+        from pillow_heif import register_heif_opener
+    except ImportError:
+        log.warning("⚠️  pillow-heif未安装，HEIC格式将被跳过")
+        return False
     register_heif_opener()
-    HEIC_SUPPORTED = True
-except ImportError:
-    HEIC_SUPPORTED = False
-    print("⚠️  pillow-heif未安装，HEIC格式将被跳过")
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _ext_supported(ext: str) -> bool:
+    """小写扩展名是否支持；实际出现的扩展名只有少数几种，结果缓存"""
+    if ext in _HEIC_FORMATS:
+        return _heic_supported()
+    return ext in SUPPORTED_IMAGE_FORMATS
+
+
+def _thread_buffer() -> io.BytesIO:
+    """当前线程复用的编码缓冲区（清空后返回），避免每张图片重新分配"""
+    buffer = getattr(_thread_local, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_local.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    return buffer
 
 
 class ImageAnalyzer:
     def __init__(self):
         if not OPENAI_API_KEY:
             raise ValueError("请在 .env 文件中设置 OPENAI_API_KEY")
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        # openai导入需要几百毫秒，只在真正调用API时导入（--verify等模式不需要）
+        from openai import DefaultHttpxClient, OpenAI
+        
+        # h2可选：安装后OpenAI请求使用HTTP/2，并发请求复用同一条连接，省去额外的TCP/TLS握手
+        # DefaultHttpxClient 沿用SDK默认的超时（600秒，多图请求可能需要较长时间）和连接数限制
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            self.client = OpenAI(api_key=OPENAI_API_KEY)
+            return
+        self.client = OpenAI(api_key=OPENAI_API_KEY, http_client=DefaultHttpxClient(http2=True))
     
     def is_supported_format(self, file_path: str) -> bool:
         """检查文件格式是否支持"""
-        ext = os.path.splitext(file_path.lower())[1]
-        
-        # 检查HEIC/HEIF格式
-        if ext in {'.heic', '.heif'}:
-            if not HEIC_SUPPORTED:
-                print(f"  ⚠️  HEIC格式需要pillow-heif支持，跳过: {os.path.basename(file_path)}")
-                return False
+        # 只对扩展名部分转小写，不复制整个路径；与splitext一致，文件名开头的点不算扩展名
+        dot = file_path.rfind('.')
+        if dot <= file_path.rfind(os.sep) + 1:
+            return False
+        ext = file_path[dot:].lower()
+        if _ext_supported(ext):
             return True
         
-        return ext in SUPPORTED_IMAGE_FORMATS
+        # HEIC/HEIF格式需要pillow-heif
+        if ext in _HEIC_FORMATS:
+            log.warning(f"  ⚠️  HEIC格式需要pillow-heif支持，跳过: {os.path.basename(file_path)}")
+        return False
     
     def encode_image(self, image_path: str) -> str:
-        """将图片编码为base64"""
+        """将图片缩放后编码为data URL（data:<mime>;base64,...）"""
+        # batch_analyze在格式检查之前编码，HEIC解码器需要在打开前注册
+        if os.path.splitext(image_path)[1].lower() in _HEIC_FORMATS:
+            _heic_supported()
         try:
-            # 使用PIL优化图片大小以减少API调用成本
+            # 空文件、损坏或扩展名不符的文件直接拒绝，不必让PIL逐个尝试解码器
+            with open(image_path, 'rb') as f:
+                if not _looks_like_image(f.read(12)):
+                    raise ValueError("不是有效的图片文件")
+            
+            # 使用PIL优化图片大小以减少API调用成本；Image.open只读取文件头，尺寸判断不需要解码像素
             with Image.open(image_path) as img:
+                max_size = (VISION_MAX_IMAGE_SIZE, VISION_MAX_IMAGE_SIZE)
+                fits = img.size[0] <= max_size[0] and img.size[1] <= max_size[1]
+                
+                # 只有真正带透明通道的图片才保留PNG，其余统一转为体积更小的JPEG
+                has_alpha = img.mode in ('RGBA', 'LA') or (
+                    img.mode == 'P' and 'transparency' in img.info)
+                
+                # 尺寸合规的小文件如果本来就是目标格式，无需解码和重新编码，直接上传原文件
+                # （CMYK等JPEG并非所有解码器都支持，仍然转换为RGB）
+                if fits and os.path.getsize(image_path) < VISION_PASSTHROUGH_BYTES:
+                    if img.format == 'JPEG' and img.mode in ('RGB', 'L'):
+                        with open(image_path, 'rb') as f:
+                            return self._data_url('image/jpeg', f.read())
+                    if img.format == 'PNG' and has_alpha:
+                        with open(image_path, 'rb') as f:
+                            return self._data_url('image/png', f.read())
+                
+                # 不透明的超大图片优先交给libvips缩放和编码（CMYK等特殊模式仍由PIL转换）
+                pyvips = None
+                if not fits and not has_alpha and img.mode in ('RGB', 'L'):
+                    pyvips = _load_pyvips()
+                if pyvips is not None:
+                    try:
+                        data = pyvips.Image.thumbnail(
+                            image_path, VISION_MAX_IMAGE_SIZE, size=pyvips.Size.DOWN
+                        ).jpegsave_buffer(Q=VISION_JPEG_QUALITY, strip=True)
+                    except pyvips.Error:
+                        # libvips不支持的格式（如编译时未带HEIC支持）退回PIL
+                        pass
+                    else:
+                        return self._data_url('image/jpeg', data)
+                
                 # 如果图片太大，调整大小
-                max_size = (1024, 1024)
-                if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+                if not fits:
+                    if img.format == 'JPEG':
+                        # 让libjpeg在解码时直接按1/2、1/4、1/8缩小，再由thumbnail缩放到精确尺寸
+                        img.draft('RGB', max_size)
+                    img.thumbnail(max_size, RESIZE_FILTER)
                 
-                # 转换为RGB格式（如果需要）
-                if img.mode not in ('RGB', 'RGBA'):
-                    img = img.convert('RGB')
+                buffer = _thread_buffer()
+                if has_alpha:
+                    if img.mode != 'RGBA':
+                        img = img.convert('RGBA')
+                    img.save(buffer, format='PNG')
+                    mime_type = 'image/png'
+                else:
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
+                    # 明确使用最快的编码参数：4:2:0色度抽样、不做第二遍霍夫曼优化、非渐进式
+                    img.save(buffer, format='JPEG', quality=VISION_JPEG_QUALITY,
+                             subsampling=2, optimize=False, progressive=False)
+                    mime_type = 'image/jpeg'
                 
-                # 保存到内存并编码
-                import io
-                buffer = io.BytesIO()
-                format_name = 'PNG' if img.mode == 'RGBA' else 'JPEG'
-                img.save(buffer, format=format_name, quality=85)
-                return base64.b64encode(buffer.getvalue()).decode('utf-8')
+                # 直接对缓冲区做base64，不先复制出bytes；视图必须在缓冲区下次复用前释放
+                with buffer.getbuffer() as data:
+                    return self._data_url(mime_type, data)
                 
         except Exception as e:
             raise ValueError(f"无法读取图片 {image_path}: {str(e)}")
     
-    def analyze_image(self, image_path: str, screenshot_mode: bool = False) -> Optional[str]:
+    @staticmethod
+    def _data_url(mime_type: str, data) -> str:
+        """拼接data URL，MIME类型与实际编码格式保持一致"""
+        return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+    
+    def analyze_image(self, image_path: str, screenshot_mode: bool = False,
+                      image_url: Optional[str] = None) -> Optional[str]:
         """分析单张图片并返回描述
         
         Args:
             image_path: 图片路径
             screenshot_mode: 是否使用截图模式（专门优化文字识别）
+            image_url: 已经编码好的图片data URL，不传时在这里编码
         """
         if not self.is_supported_format(image_path):
-            print(f"跳过不支持的格式: {image_path}")
+            log.info(f"跳过不支持的格式: {image_path}")
             return None
             
         try:
             # 编码图片
-            base64_image = self.encode_image(image_path)
+            if image_url is None:
+                image_url = self.encode_image(image_path)
             
             # 根据模式选择提示词和token限制
-            if screenshot_mode:
-                prompt = SCREENSHOT_VISION_PROMPT
-                max_tokens = 500  # 截图模式需要更多token来描述文字内容
-                mode_text = "截图模式"
-            else:
-                prompt = VISION_PROMPT
-                max_tokens = 300
-                mode_text = "普通模式"
+            prompt, max_tokens, mode_text = self._prompt_for(screenshot_mode)
             
             # 调用OpenAI Vision API
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",  # 使用cost-effective的模型
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=max_tokens
-            )
-            
-            description = response.choices[0].message.content.strip()
-            print(f"✅ 已分析（{mode_text}）: {os.path.basename(image_path)}")
+            description = self._complete(prompt, [image_url], max_tokens)
+            log.info(f"✅ 已分析（{mode_text}）: {os.path.basename(image_path)}")
             return description
             
         except Exception as e:
-            print(f"❌ 分析失败 {image_path}: {str(e)}")
+            log.error(f"❌ 分析失败 {image_path}: {str(e)}")
+            return None
+    
+    @staticmethod
+    def _prompt_for(screenshot_mode: bool):
+        """返回 (提示词, 单张图片的token上限, 模式名称)"""
+        if screenshot_mode:
+            # 截图模式需要更多token来描述文字内容
+            return SCREENSHOT_VISION_PROMPT, 500, "截图模式"
+        return VISION_PROMPT, 300, "普通模式"
+    
+    def _complete(self, prompt: str, image_urls: List[str], max_tokens: int) -> str:
+        """发送一条包含提示词和若干图片的消息，返回模型的回复"""
+        content = [{"type": "text", "text": prompt}]
+        content.extend({"type": "image_url", "image_url": {"url": url}} for url in image_urls)
+        response = self.client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content.strip()
+    
+    def analyze_images_bulk(self, image_paths: List[str], group_prompt: str, max_tokens: int,
+                            image_urls: Optional[List[str]] = None) -> Optional[str]:
+        """把多张图片放在同一条消息中，用一次API请求分析，返回模型的完整回复
+        
+        Args:
+            image_paths: 图片路径列表（按此顺序放入消息）
+            group_prompt: 针对整组图片的提示词
+            max_tokens: 整个回复的token上限
+            image_urls: 已经编码好的data URL，与image_paths一一对应，不传时在这里编码
+        """
+        try:
+            if image_urls is None:
+                image_urls = [self.encode_image(image_path) for image_path in image_paths]
+            return self._complete(group_prompt, image_urls, max_tokens)
+        except Exception as e:
+            log.error(f"❌ 多图分析失败（{len(image_paths)}张）: {str(e)}")
             return None
     
-    def batch_analyze(self, image_paths: list, screenshot_mode: bool = False) -> dict:
+    def analyze_group(self, image_paths: List[str], screenshot_mode: bool = False) -> Dict[str, str]:
+        """一次请求分析一组图片（如同一相册、连续截图），返回每张图片各自的描述
+        
+        省去每张图片单独请求的连接开销和重复的提示词token。回复中缺少某张图片的分节时，
+        该图片单独重新分析；分析失败的图片不在结果中。
+        """
+        image_paths = [p for p in image_paths if self.is_supported_format(p)]
+        if len(image_paths) <= 1:
+            results = {p: self.analyze_image(p, screenshot_mode) for p in image_paths}
+            return {p: d for p, d in results.items() if d}
+        
+        # 编码失败的图片不放入请求
+        encoded = {}
+        for image_path in image_paths:
+            try:
+                encoded[image_path] = self.encode_image(image_path)
+            except Exception as e:
+                log.error(f"❌ 分析失败 {image_path}: {str(e)}")
+        paths = list(encoded)
+        if not paths:
+            # 全部编码失败时不发送只有提示词的请求
+            return {}
+        
+        prompt, max_tokens, mode_text = self._prompt_for(screenshot_mode)
+        group_prompt = GROUP_VISION_PROMPT.format(count=len(paths), prompt=prompt)
+        reply = self.analyze_images_bulk(paths, group_prompt, max_tokens * len(paths), list(encoded.values()))
+        
+        results = {}
+        if reply:
+            # re.split 带捕获组时结果为 [前言, 序号, 内容, 序号, 内容, ...]
+            parts = _GROUP_SECTION_RE.split(reply)
+            for number, section in zip(parts[1::2], parts[2::2]):
+                index = int(number) - 1
+                section = section.strip()
+                if 0 <= index < len(paths) and section:
+                    results[paths[index]] = section
+            log.info(f"✅ 已分析（{mode_text}，{len(paths)}张合并请求）: "
+                     f"{', '.join(os.path.basename(p) for p in results)}")
+        
+        # 回复中没有对应分节的图片单独分析
+        for image_path in paths:
+            if image_path not in results:
+                description = self.analyze_image(image_path, screenshot_mode, encoded[image_path])
+                if description:
+                    results[image_path] = description
+        return results
+    
+    def batch_analyze(self, image_paths: list, screenshot_mode: bool = False,
+                      max_workers: int = VISION_CONCURRENCY) -> dict:
         """批量分析图片
         
+        分析耗时主要在网络往返，用线程池同时发送多个请求；遇到429/5xx时由OpenAI客户端自带的重试（指数退避）处理。
+        
         Args:
             image_paths: 图片路径列表
             screenshot_mode: 是否使用截图模式
+            max_workers: 同时进行的请求数
         """
         results = {}
+        # 编码（CPU）与请求（网络）流水线化：当前线程编码后续图片的同时，线程池中的请求在等待响应；
+        # 已编码但尚未完成的图片最多 2*max_workers 张，避免编码结果堆积占用内存
+        slots = threading.BoundedSemaphore(max_workers * 2)
         
-        for i, image_path in enumerate(image_paths, 1):
-            print(f"[{i}/{len(image_paths)}] 正在分析: {os.path.basename(image_path)}")
-            description = self.analyze_image(image_path, screenshot_mode)
-            if description:
-                results[image_path] = description
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for image_path in image_paths:
+                slots.acquire()
+                try:
+                    image_url = self.encode_image(image_path)
+                except Exception:
+                    # 交给analyze_image重新编码并报告错误
+                    image_url = None
+                future = executor.submit(self.analyze_image, image_path, screenshot_mode, image_url)
+                future.add_done_callback(lambda _: slots.release())
+                futures[future] = image_path
+            
+            # 进度在当前线程中按完成顺序输出
+            for i, future in enumerate(as_completed(futures), 1):
+                image_path = futures[future]
+                description = future.result()
+                log.info(f"[{i}/{len(image_paths)}] 分析完成: {os.path.basename(image_path)}")
+                if description:
+                    results[image_path] = description
         
-        return results
\ No newline at end of file
+        # 结果按输入顺序排列
+        return {image_path: results[image_path] for image_path in image_paths if image_path in results}